@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+オフライン・ベンチマーク
+R2（S3互換）と YouTube のアップロードAPIをローカルの偽サーバーで置き換え、
+合成音声を使って process_batch をエンドツーエンドで計測します
+
+使い方:
+  python benchmark.py --files 4 --durations 300,600 --mode pipeline --encode-profile fast
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import urllib.parse
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+import youtube_uploader as yu
+
+
+# ========================================
+# 偽 R2（S3互換）サーバー
+# ========================================
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """ListObjectsV2 / GetObject(Range) / HeadObject / PutObject(条件付き) / DeleteObject のみ対応"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.objects
+
+    def _split_path(self):
+        parts = urllib.parse.urlsplit(self.path)
+        bucket, _, key = parts.path.lstrip('/').partition('/')
+        return urllib.parse.unquote(bucket), urllib.parse.unquote(key), urllib.parse.parse_qs(parts.query)
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'
+        self._send(status, body.encode('utf-8'), {'Content-Type': 'application/xml'})
+
+    def _object_headers(self, obj):
+        return {
+            'ETag': f'"{obj["etag"]}"',
+            'Last-Modified': formatdate(obj['mtime'], usegmt=True),
+            'Content-Type': obj['content_type'],
+            'Accept-Ranges': 'bytes',
+        }
+
+    def _list(self, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        token = query.get('continuation-token', [None])[0]
+        start_after = token or query.get('start-after', [None])[0]
+
+        with self.server.lock:
+            keys = sorted(k for k in self.store if k.startswith(prefix) and (not start_after or k > start_after))
+            page = keys[:max_keys]
+            objects = [(k, self.store[k]) for k in page]
+        truncated = len(keys) > max_keys
+
+        contents = ''.join(
+            f'<Contents><Key>{escape(k)}</Key>'
+            f'<LastModified>{datetime.fromtimestamp(o["mtime"], timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")}</LastModified>'
+            f'<ETag>&quot;{o["etag"]}&quot;</ETag><Size>{len(o["data"])}</Size>'
+            f'<StorageClass>STANDARD</StorageClass></Contents>'
+            for k, o in objects
+        )
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f'<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>'
+            f'<KeyCount>{len(objects)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>'
+            f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>'
+            + (f'<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>' if truncated else '')
+            + contents
+            + '</ListBucketResult>'
+        )
+        self._send(200, body.encode('utf-8'), {'Content-Type': 'application/xml'})
+
+    def do_GET(self):
+        bucket, key, query = self._split_path()
+        if not key:
+            return self._list(bucket, query)
+
+        with self.server.lock:
+            obj = self.store.get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey')
+
+        data = obj['data']
+        headers = self._object_headers(obj)
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            self.send_response(304)
+            self.send_header('ETag', headers['ETag'])
+            self.end_headers()
+            return
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start, _, end = byte_range.replace('bytes=', '').partition('-')
+            start = int(start)
+            end = min(int(end) if end else len(data) - 1, len(data) - 1)
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+            return self._send(206, data[start:end + 1], headers)
+        self._send(200, data, headers)
+
+    def do_HEAD(self):
+        _, key, _ = self._split_path()
+        with self.server.lock:
+            obj = self.store.get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey')
+        headers = self._object_headers(obj)
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(obj['data'])))
+        self.end_headers()
+
+    def do_PUT(self):
+        _, key, _ = self._split_path()
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if_match = self.headers.get('If-Match')
+        if_none_match = self.headers.get('If-None-Match')
+
+        with self.server.lock:
+            current = self.store.get(key)
+            if if_none_match == '*' and current is not None:
+                return self._error(412, 'PreconditionFailed')
+            if if_match and (current is None or if_match.strip('"') != current['etag']):
+                return self._error(412, 'PreconditionFailed')
+            obj = self.server.put(key, data, self.headers.get('Content-Type', 'binary/octet-stream'))
+        self._send(200, b'', {'ETag': f'"{obj["etag"]}"'})
+
+    def do_DELETE(self):
+        _, key, _ = self._split_path()
+        with self.server.lock:
+            self.store.pop(key, None)
+        self._send(204)
+
+
+class FakeS3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeS3Handler)
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put(self, key, data, content_type='binary/octet-stream'):
+        obj = {
+            'data': data,
+            'etag': hashlib.md5(data).hexdigest(),
+            'mtime': time.time(),
+            'content_type': content_type,
+        }
+        self.objects[key] = obj
+        return obj
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+# ========================================
+# 偽 YouTube アップロードサーバー
+# ========================================
+
+class FakeYouTubeHandler(BaseHTTPRequestHandler):
+    """
+    videos.insert（再開可能アップロード）・thumbnails.set と、
+    照合用の channels.list / playlistItems.list / videos.list（バッチ含む）に対応
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        """帯域制限をかけながら本文を読む"""
+        remaining = int(self.headers.get('Content-Length', 0))
+        bandwidth = self.server.bandwidth
+        chunks = []
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            chunks.append(chunk)
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+        data = b''.join(chunks)
+        self.server.count('bytes_received', len(data))
+        return data
+
+    def _api_get(self, path, query):
+        """読み取り系APIの (ステータス, 応答JSON)"""
+        with self.server.lock:
+            videos = list(self.server.videos.items())
+        if path.endswith('/channels'):
+            return 200, {'items': [{'id': 'UCbench', 'contentDetails': {'relatedPlaylists': {'uploads': 'UUbench'}}}]}
+        if path.endswith('/playlistItems'):
+            start = int(query.get('pageToken', ['0'])[0])
+            size = int(query.get('maxResults', ['5'])[0])
+            # 新しい順
+            page = list(reversed(videos))[start:start + size]
+            payload = {'items': [
+                {'snippet': {'title': v['title'], 'resourceId': {'videoId': video_id}}} for video_id, v in page
+            ]}
+            if start + size < len(videos):
+                payload['nextPageToken'] = str(start + size)
+            return 200, payload
+        if path.endswith('/videos'):
+            ids = query.get('id', [''])[0].split(',')
+            found = dict(videos)
+            return 200, {'items': [
+                {
+                    'id': video_id,
+                    'status': {'uploadStatus': 'processed', 'publishAt': found[video_id]['publish_at']},
+                    'processingDetails': {'processingStatus': 'succeeded', 'thumbnailsAvailability': 'available'},
+                } for video_id in ids if video_id in found
+            ]}
+        return 404, {'error': {'code': 404, 'message': path}}
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        parts = urllib.parse.urlsplit(self.path)
+        self.server.count('api_requests')
+        status, payload = self._api_get(parts.path, urllib.parse.parse_qs(parts.query))
+        self._send_json(status, payload)
+
+    def _batch(self, body):
+        """multipart/mixed のバッチリクエストを1件ずつ処理してまとめて返す"""
+        import email.parser
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+        boundary = 'batch_' + uuid.uuid4().hex
+        out = []
+        for part in message.get_payload():
+            request_line = part.get_payload().split('\n', 1)[0].strip()
+            target = urllib.parse.urlsplit(request_line.split(' ')[1])
+            self.server.count('batched_calls')
+            status, payload = self._api_get(target.path, urllib.parse.parse_qs(target.query))
+            content = json.dumps(payload)
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'].strip('<>')}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(content)}\r\n\r\n{content}\r\n"
+            )
+        data = (''.join(out) + f"--{boundary}--\r\n").encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        body = self._read_body()
+
+        if parts.path.startswith('/batch'):
+            self.server.count('api_requests')
+            return self._batch(body)
+
+        if parts.path.endswith('/videos') and query.get('uploadType') == ['resumable']:
+            session = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.sessions[session] = {
+                    'metadata': json.loads(body or b'{}'),
+                    'total': int(self.headers.get('X-Upload-Content-Length', 0)) or None,
+                    'received': 0,
+                }
+            self.server.count('sessions')
+            location = f'http://127.0.0.1:{self.server.server_address[1]}/upload/session/{session}'
+            self.send_response(200)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if parts.path.endswith('/thumbnails/set'):
+            self.server.count('thumbnails')
+            return self._send_json(200, {'kind': 'youtube#thumbnailSetResponse', 'items': []})
+
+        self._send_json(404, {'error': {'code': 404, 'message': parts.path}})
+
+    def do_PUT(self):
+        time.sleep(self.server.latency)
+        session_id = self.path.rstrip('/').rsplit('/', 1)[-1]
+        with self.server.lock:
+            session = self.server.sessions.get(session_id)
+        if session is None:
+            self._read_body()
+            return self._send_json(404, {'error': {'code': 404, 'message': 'session not found'}})
+
+        # Content-Range: bytes a-b/total もしくは bytes */total（現在位置の問い合わせ）
+        content_range = self.headers.get('Content-Range', '')
+        data = self._read_body()
+        spec, _, total = content_range.replace('bytes ', '').partition('/')
+        if total and total != '*':
+            session['total'] = int(total)
+        if spec != '*' and data:
+            start = int(spec.split('-')[0])
+            if start == session['received']:
+                session['received'] += len(data)
+
+        if session['total'] is not None and session['received'] >= session['total']:
+            video_id = uuid.uuid4().hex[:11]
+            metadata = session['metadata']
+            with self.server.lock:
+                self.server.videos[video_id] = {
+                    'title': metadata.get('snippet', {}).get('title', ''),
+                    'publish_at': metadata.get('status', {}).get('publishAt'),
+                }
+            self.server.count('videos')
+            return self._send_json(200, {'kind': 'youtube#video', 'id': video_id})
+
+        headers = {'Range': f'bytes=0-{session["received"] - 1}'} if session['received'] else {}
+        self.send_response(308)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class FakeYouTubeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, bandwidth=0, latency=0.0):
+        super().__init__(('127.0.0.1', 0), FakeYouTubeHandler)
+        self.bandwidth = bandwidth        # バイト/秒（0 なら無制限）
+        self.latency = latency            # リクエスト毎の遅延（秒）
+        self.sessions = {}
+        self.videos = {}                  # 動画ID → タイトル等（アップロード順）
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    @property
+    def host(self):
+        return f'127.0.0.1:{self.server_address[1]}'
+
+
+class RedirectHttp:
+    """googleapiclient の通信先を偽サーバーに付け替える（本番と同じ PooledHttp を使う）"""
+
+    def __init__(self, host):
+        self.host = host
+        self.http = yu.PooledHttp()
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        parts = urllib.parse.urlsplit(uri)
+        uri = urllib.parse.urlunsplit(('http', self.host, parts.path, parts.query, ''))
+        return self.http.request(
+            uri, method, body=body, headers=headers, redirections=redirections, connection_type=connection_type
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+# ========================================
+# 合成音声
+# ========================================
+
+def make_fixtures(directory, durations, count, fmt='m4a'):
+    """指定長さのピンクノイズ音声（モノラル・話し声相当のビットレート）を生成"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        duration = durations[i % len(durations)]
+        path = os.path.join(directory, f'{i:04d}_ベンチマーク{i}.{fmt}')
+        if not os.path.exists(path):
+            codec = ['-c:a', 'aac', '-b:a', '96k'] if fmt == 'm4a' else ['-c:a', 'libmp3lame', '-b:a', '96k']
+            subprocess.run(
+                ['ffmpeg', '-v', 'error', '-y',
+                 '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.05:sample_rate=44100:duration={duration}',
+                 '-ac', '1'] + codec + [path],
+                check=True
+            )
+        paths.append(path)
+    return paths
+
+
+# ========================================
+# 計測
+# ========================================
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='yt_bench_')
+    durations = [int(d) for d in args.durations.split(',')]
+    print(f"🎧 合成音声を準備中 ({args.files}本, {durations}秒)...")
+    fixtures = make_fixtures(args.fixtures_dir or os.path.join(workdir, 'fixtures'), durations, args.files, args.format)
+
+    s3 = FakeS3Server()
+    youtube = FakeYouTubeServer(bandwidth=args.bandwidth_mbps * 1e6 / 8, latency=args.latency_ms / 1000)
+    for server in (s3, youtube):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    for path in fixtures:
+        with open(path, 'rb') as f:
+            s3.put(os.path.basename(path), f.read(), 'audio/mp4')
+    audio_bytes = sum(os.path.getsize(p) for p in fixtures)
+
+    # 本番設定を偽サーバー向けに差し替える
+    yu.R2_CONFIG.update(endpoint_url=s3.url, access_key_id='bench', secret_access_key='bench', bucket_name='bench')
+    yu.CACHE_CONFIG.update(enabled=args.cache, dir=os.path.join(workdir, 'cache'))
+    # 偽サーバーはクォータを数えないので、本数が制限されないようにする
+    yu.QUOTA_CONFIG['daily_limit'] = 10 ** 9
+    yu.THUMBNAIL_CONFIG['template_image'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnail_template.jpg')
+
+    tracemalloc.start()
+    started = time.perf_counter()
+
+    metrics = yu.RunMetrics(events_path=args.events)
+    uploader = yu.YouTubeUploader(metrics=metrics)
+    uploader.encode_profile = args.encode_profile
+    uploader.stream_input = args.stream_input
+    uploader.stream_output = args.stream_output
+
+    from googleapiclient.discovery import build
+    uploader.youtube = build('youtube', 'v3', http=RedirectHttp(youtube.host), static_discovery=True)
+    uploader.thread_safe_client = True
+
+    workers = {name: count for name, count in (
+        ('download', args.download_workers),
+        ('encode', args.encode_workers),
+        ('upload', args.upload_workers),
+    ) if count}
+    uploader.process_batch(limit=args.files, pipeline=args.mode == 'pipeline', workers=workers)
+
+    wall = time.perf_counter() - started
+    _, peak_python = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    audio_seconds = uploader.transcoder.audio_seconds
+    result = {
+        'mode': args.mode,
+        'encode_profile': args.encode_profile,
+        'stream_input': args.stream_input,
+        'stream_output': args.stream_output,
+        'files': args.files,
+        'uploaded': youtube.stats.get('videos', 0),
+        'wall_seconds': wall,
+        'files_per_minute': args.files / wall * 60,
+        'audio_minutes_per_second': (audio_seconds / 60) / wall if wall else 0,
+        'audio_bytes': audio_bytes,
+        'uploaded_bytes': youtube.stats.get('bytes_received', 0),
+        'peak_python_mb': peak_python / 1e6,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'stages': metrics.summary(),
+    }
+
+    s3.shutdown()
+    youtube.shutdown()
+    return result
+
+
+def print_result(result):
+    print("\n" + "=" * 60)
+    print(f"📊 ベンチマーク結果 ({result['mode']}, profile={result['encode_profile']}, stream={result['stream_input']}/{result['stream_output']})")
+    print("=" * 60)
+    print(f"  ファイル数      : {result['uploaded']}/{result['files']} アップロード")
+    print(f"  実時間          : {result['wall_seconds']:.1f}秒 ({result['files_per_minute']:.2f} 本/分)")
+    print(f"  音声処理速度    : {result['audio_minutes_per_second']:.2f} 音声分/秒")
+    print(f"  送信量          : {result['uploaded_bytes'] / 1e6:.1f}MB (音声 {result['audio_bytes'] / 1e6:.1f}MB)")
+    print(f"  ピークメモリ    : Python {result['peak_python_mb']:.1f}MB / RSS {result['peak_rss_mb']:.1f}MB / ffmpeg {result['peak_child_rss_mb']:.1f}MB")
+    print("  ステージ別（秒）:")
+    for stage, timing in result['stages'].items():
+        rate = f"  {timing['bitrate_bps'] / 1e6:6.2f}Mbps" if timing['bitrate_bps'] else ''
+        print(f"    {stage:<14} 合計 {timing['seconds']:7.2f}  平均 {timing['seconds'] / timing['count']:6.2f}  ({timing['count']}回){rate}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='YouTube自動アップローダー オフラインベンチマーク')
+    parser.add_argument('--files', type=int, default=4, help='処理するファイル数')
+    parser.add_argument('--durations', default='300,600,900', help='合成音声の長さ（秒、カンマ区切りで循環）')
+    parser.add_argument('--format', choices=['m4a', 'mp3'], default='m4a', help='合成音声の形式')
+    parser.add_argument('--fixtures-dir', help='合成音声の保存先（指定すると再利用）')
+    parser.add_argument('--mode', choices=['sequential', 'pipeline'], default='sequential')
+    parser.add_argument('--encode-profile', choices=sorted(yu.ENCODE_PROFILES), default=yu.ENCODE_CONFIG['profile'])
+    parser.add_argument('--stream-input', action='store_true')
+    parser.add_argument('--stream-output', action='store_true', help='変換しながらアップロードする')
+    parser.add_argument('--cache', action='store_true', help='生成物キャッシュを有効にする')
+    parser.add_argument('--download-workers', type=int)
+    parser.add_argument('--encode-workers', type=int)
+    parser.add_argument('--upload-workers', type=int)
+    parser.add_argument('--bandwidth-mbps', type=float, default=50, help='偽YouTubeの受信帯域（Mbps、0で無制限）')
+    parser.add_argument('--latency-ms', type=float, default=50, help='偽YouTubeのリクエスト遅延（ms）')
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    parser.add_argument('--events', help='ステージ毎の計測イベント（JSON Lines）の出力先')
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    print_result(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 {args.json} に保存しました")
+
+
+if __name__ == '__main__':
+    main()
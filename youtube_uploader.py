@@ -7,19 +7,31 @@ GitHub Actions対応版
 
 import os
 import sys
+import json
+import time
 import subprocess
 import tempfile
-from datetime import datetime, timedelta
+import shutil
+import threading
+import queue
+import traceback
+import functools
+import hashlib
+import random
+import http.client
+import contextlib
+import uuid
+import cProfile
+import tracemalloc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 import re
 import argparse
-import boto3
-from botocore.exceptions import ClientError
-from PIL import Image, ImageDraw, ImageFont
-import google_auth_oauthlib.flow
-import googleapiclient.discovery
-import googleapiclient.errors
-from googleapiclient.http import MediaFileUpload
+import base64
+import unicodedata
+# boto3・botocore・PIL・googleapiclient は読み込みが重いので、必要になった処理の中で import する
 
 # ========================================
 # 設定
@@ -38,9 +50,12 @@ R2_CONFIG = {
 YOUTUBE_CONFIG = {
     'client_secrets_file': 'client_secrets.json',
     'scopes': ['https://www.googleapis.com/auth/youtube.upload'],
+    'reconcile_scopes': ['https://www.googleapis.com/auth/youtube.readonly'],   # --reconcile で追加で必要
     'category_id': '24',
     'privacy_status': 'private',
     'tags': ['昔話', '民話', '日本の昔話', '読み聞かせ', 'ひさこばあば'],
+    'token_file': 'token.json',
+    'refresh_margin_minutes': 10,   # 有効期限までこれより短ければ先にリフレッシュ（それ以外は通信しない）
 }
 
 # サムネイル設定
@@ -48,6 +63,20 @@ THUMBNAIL_CONFIG = {
     'template_image': 'thumbnail_template.jpg',
     'font_path': '/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc',
     'text_color': 'white',
+    'outline_color': 'black',
+    'outline_width': 3,
+    'band_center_x': 640,
+    'max_text_width': 760,
+    'font_sizes': list(range(90, 34, -5)),   # 大きい順に試すフォントサイズ（90〜35px、5px刻み）
+}
+
+# サムネイル事前生成設定（--prerender 指定時: 未公開分のサムネイルをまとめて作ってR2に置く）
+PRERENDER_CONFIG = {
+    'r2_prefix': 'youtube_thumbnails/',
+    'manifest_key': 'youtube_thumbnails/manifest.json',   # 元ファイル → サムネイルのキャッシュキー・R2キー
+    'max_bytes': 2 * 1024 * 1024,                         # YouTube のサムネイル上限（2MB）
+    'jpeg_qualities': [90, 85, 80, 70, 60],               # 上限に収まるまで順に下げる
+    'workers': os.cpu_count() or 1,                       # 描画プロセス数
 }
 
 # 概要欄テンプレート
@@ -71,108 +100,2884 @@ UPLOAD_CONFIG = {
     'start_date': '2025-12-27',
     'videos_per_day': 2,
     'publish_time': '09:00:00',
+    # 分割アップロード設定（チャンクは 256KiB の倍数）
+    'chunk_size': 8 * 1024 * 1024,           # 初期チャンクサイズ
+    'min_chunk_size': 1 * 1024 * 1024,
+    'max_chunk_size': 64 * 1024 * 1024,
+    'target_chunk_seconds': 10,              # 1チャンクの送信にかける目標時間（実測速度から調整）
+    'max_retries': 8,                        # 5xx・接続エラー時の再試行回数
+    'retry_base_seconds': 2,                 # 指数バックオフの初期待ち時間
+    'retry_max_seconds': 120,
+    'session_key': 'youtube_upload_sessions.json',   # 中断したアップロードの再開情報（R2上）
+    'session_max_age_hours': 24 * 6,         # YouTubeの再開用URIは約1週間で失効する
+}
+
+# 再試行するHTTPステータス
+RETRYABLE_STATUS_CODES = (500, 502, 503, 504)
+
+
+def retryable_exceptions():
+    """再試行する通信例外（httplib2 は使うときに読み込む）"""
+    import httplib2
+    return (httplib2.HttpLib2Error, http.client.HTTPException, OSError)
+
+# YouTube API 通信設定（実行中のすべてのAPI呼び出しで1つのコネクションプールを共有する）
+HTTP_CONFIG = {
+    'pool_connections': 4,       # 接続先ホスト毎のプール数
+    'pool_maxsize': 8,           # ホスト毎に保持する keep-alive 接続数（アップロード並列数以上にする）
+    'connect_timeout': 10,
+    'read_timeout': 300,         # 大きいチャンクの送信完了待ちを含むので長め
+    'retries': 3,                # 接続エラーと、GET の 5xx/429 の再試行回数
+    'backoff_factor': 1.0,
+}
+
+
+class PooledHttp:
+    """
+    requests のセッション（urllib3 のコネクションプール）を httplib2.Http の代わりに使うアダプター
+    googleapiclient は http.request(...) → (httplib2.Response, 本文) しか使わないので、その形に合わせて返す。
+    セッションはスレッド間で共有でき、keep-alive で TLS ハンドシェイクを使い回す。
+    credentials を渡すと AuthorizedSession でトークンの付与と 401 時のリフレッシュも行う
+    """
+
+    def __init__(self, credentials=None, config=HTTP_CONFIG):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        if credentials is not None:
+            from google.auth.transport.requests import AuthorizedSession
+            self.session = AuthorizedSession(credentials)
+        else:
+            self.session = requests.Session()
+
+        # 送信が終わっていない接続エラーはどのメソッドでも安全に再試行できる。
+        # ステータスでの再試行は GET のみ（アップロードの再試行は _upload_resumable が行う）
+        retry = Retry(
+            total=config['retries'],
+            connect=config['retries'],
+            read=0,
+            status_forcelist=(429,) + RETRYABLE_STATUS_CODES,
+            allowed_methods=frozenset(['GET']),
+            backoff_factor=config['backoff_factor'],
+            raise_on_status=False,
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=config['pool_connections'],
+            pool_maxsize=config['pool_maxsize'],
+            max_retries=retry,
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = (config['connect_timeout'], config['read_timeout'])
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        import httplib2
+        response = self.session.request(
+            method, uri,
+            data=body,
+            headers=headers,
+            timeout=self.timeout,
+            # 再開可能アップロードの 308 はリダイレクトではない
+            allow_redirects=method in ('GET', 'HEAD'),
+        )
+        info = {name.lower(): value for name, value in response.headers.items()}
+        info['status'] = str(response.status_code)
+        resp = httplib2.Response(info)
+        resp.reason = response.reason
+        return resp, response.content
+
+    def close(self):
+        self.session.close()
+
+# YouTube Data API クォータ設定（1日の上限は太平洋時間の0時にリセットされる）
+QUOTA_CONFIG = {
+    'daily_limit': 10000,
+    'reserve': 100,                              # 手動操作や一覧取得のために残しておく分
+    'costs': {                                   # API呼び出し1回あたりの消費ユニット
+        'videos.insert': 1600,
+        'thumbnails.set': 50,
+        'videos.list': 1,
+        'channels.list': 1,
+        'playlistItems.list': 1,
+    },
+    'ledger_key': 'youtube_quota_ledger.json',   # 当日の消費量の記録（R2上）
+    'timezone': 'America/Los_Angeles',
+    'max_retries': 5,                            # 条件付き書き込みが競合したときの再試行回数
+}
+
+# クォータ切れを示す 403 の reason
+QUOTA_ERROR_REASONS = ('quotaExceeded', 'dailyLimitExceeded', 'uploadLimitExceeded')
+
+# 一時的な流量制限を示す 403 の reason（日次クォータとは別。待って再試行する）
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+class QuotaExceededError(Exception):
+    """YouTube API のクォータが尽きた（これ以上の処理は無駄になる）"""
+
+
+def _has_error_reason(error, reasons):
+    """HttpError が 403 で、reason が reasons のいずれかか"""
+    if getattr(error, 'resp', None) is None or error.resp.status != 403:
+        return False
+    details = getattr(error, 'error_details', None) or []
+    if isinstance(details, list):
+        if any(isinstance(d, dict) and d.get('reason') in reasons for d in details):
+            return True
+    content = getattr(error, 'content', b'') or b''
+    return any(reason.encode() in content for reason in reasons)
+
+
+def is_quota_error(error):
+    """HttpError がクォータ切れによるものか"""
+    return _has_error_reason(error, QUOTA_ERROR_REASONS)
+
+
+def is_rate_limit_error(error):
+    """HttpError が一時的な流量制限（429 / 403 rateLimitExceeded）によるものか"""
+    if getattr(error, 'resp', None) is not None and error.resp.status == 429:
+        return True
+    return _has_error_reason(error, RATE_LIMIT_REASONS)
+
+# 常駐モード設定（--watch）
+WATCH_CONFIG = {
+    'poll_seconds': 120,          # R2の差分確認の間隔
+}
+
+
+class ShutdownRequested(Exception):
+    """停止要求（SIGTERM/SIGINT）により区切りのよいところで処理を止めた"""
+
+# ファイル毎の進捗（途中で失敗しても、次回は済んだ段階を繰り返さない）
+FILE_STATE_CONFIG = {
+    'key': 'youtube_file_states.json',   # R2上の保存先（記録まで終わったファイルは消す）
+    'max_retries': 5,                    # 条件付き書き込みが競合したときの再試行回数
+}
+
+# 段階（この順に進む）。ダウンロードした音声は実行毎の作業ディレクトリに置くので段階として残さない
+FILE_STATES = ('encoded', 'uploaded', 'thumbnail_set', 'recorded')
+
+# 音声カタログ・時間予算設定（--time-budget 指定時）
+CATALOG_CONFIG = {
+    'key': 'youtube_catalog.json',     # R2上のカタログ（キー毎の長さ・サイズ・ETag・タイトル・実測値）
+    'probe_workers': 4,                # 長さを調べる ffprobe の並列数（署名付きURLで先頭だけ読む）
+    'assumed_bit_rate': 128000,        # ffprobe できないときにサイズから長さを見積もるビットレート
+    'default_rates': {                 # 実測が無いときの見積もり
+        'download_bps': 5e6,           # バイト/秒
+        'encode_speed': 10.0,          # 音声秒/実時間秒
+        'upload_bps': 2e6,             # バイト/秒
+        'video_bytes_per_second': 40000,   # 動画1秒あたりのバイト数
+    },
+    'overhead_seconds': 15,            # 1ファイルあたりのサムネイル・API呼び出しなど
+    'smoothing': 0.3,                  # 実測値を取り込む割合（指数移動平均）
+    'safety': 0.85,                    # 予算のうち計画に使う割合（見積もりの誤差分を残す）
+}
+
+# 重複検出設定（音声の指紋と正規化タイトルで、公開済みと同じ録音を変換前に見つける）
+DEDUP_CONFIG = {
+    'enabled': True,
+    'key': 'youtube_fingerprints.json',   # R2上の指紋インデックス（キー毎の ETag・正規化タイトル・指紋）
+    'action': 'skip',                  # 'skip'（処理しない）/ 'flag'（警告だけ出して処理する）
+    'seconds': 120,                    # 先頭何秒で指紋を取るか
+    'sample_rate': 8000,
+    'frame': 2048,                     # FFT の窓（サンプル数）
+    'hop': 512,                        # 窓をずらす幅（0.064秒）
+    'bands': 17,                       # 300〜3000Hz を対数で分けた帯域数（隣の帯域との差で16ビット）
+    'band_range': (300, 3000),
+    'max_shift_seconds': 10,           # 先頭の無音・カットの違いをこの範囲で吸収する
+    'min_overlap_seconds': 30,
+    'max_bit_error': 0.3,              # ビット誤り率がこれ以下なら同じ録音（別の録音はおよそ0.5）
+    'max_new_per_run': 20,             # 1回の照合で新しく指紋を取る未処理ファイル数（先頭から）
+    'backfill_per_run': 20,            # 指紋の無い公開済みファイルを1回の実行で何件登録するか（数回で全件が揃う）
+    'workers': 4,
+}
+
+# 失敗台帳設定（失敗を公開履歴のジャーナルに記録し、繰り返し失敗する元ファイルを隔離する）
+FAILURE_CONFIG = {
+    'quarantine_after': 3,                             # この回数失敗したら隔離（--release で解除）
+    'backoff_base_hours': 1,                           # 失敗後、次に試すまでの待ち時間（失敗毎に倍）
+    'backoff_max_hours': 72,
+    'counted_stages': ('download', 'thumbnail', 'encode'),   # 元ファイルが原因になりうる段階だけ数える
 }
 
 # ★除外ファイルリスト（履歴になくても強制的にスキップするファイル）
+# 失敗台帳の初期値として隔離扱いにする（--release で解除できる）
 IGNORE_FILES = [
     "‗学徒動員のころ.m4a",
     "0806‗学徒動員のころ.m4a",
     "学徒動員のころ.m4a"
 ]
 
+# R2ダウンロード設定
+DOWNLOAD_CONFIG = {
+    'max_pool_connections': 32,          # boto3 のコネクションプール（分割ダウンロード並列数 × 先読み本数以上）
+    'retry_mode': 'adaptive',            # 失敗率に応じて送信レートも絞る再試行
+    'max_attempts': 8,
+    'connect_timeout': 10,
+    'read_timeout': 60,
+    'multipart_threshold': 16 * 1024 * 1024,   # これより大きいファイルは分割して並列ダウンロード
+    'multipart_chunksize': 8 * 1024 * 1024,
+    'max_concurrency': 8,                # 1ファイルあたりの並列数
+    'lookahead': 3,                      # 処理順の先にあるファイルを何本まで先読みしておくか
+    'disk_budget': 2 * 1024 ** 3,        # 先読みで手元に置いておける合計サイズ
+}
+
+# R2一覧取得設定
+LISTING_CONFIG = {
+    'page_size': 1000,        # list_objects_v2 の1ページあたり最大件数（R2/S3の上限は1000）
+    'prefixes': [],           # 空ならバケット全体を列挙。指定時はプレフィックス毎に並列列挙（全キーを網羅すること）
+    'max_workers': 4,         # プレフィックス並列列挙のスレッド数
+}
+
+# パイプライン設定（--pipeline 指定時）
+PIPELINE_CONFIG = {
+    'queue_size': 2,          # ステージ間キューの上限（作業ディレクトリのディスク使用量もこれで抑える）
+    'workers': {
+        'download': 2,
+        'thumbnail': 1,
+        'encode': 1,
+        'upload': 1,
+    },
+}
+
+# 動画変換（ffmpeg）設定
+ENCODE_CONFIG = {
+    'max_jobs': 1,                          # 同時に動かす ffmpeg の数（--pipeline 時に --encode-workers で上書き）
+    'total_threads': os.cpu_count() or 1,   # 全ジョブ合計の ffmpeg スレッド上限
+    'progress_step': 10,                    # 進捗表示の間隔（%）
+    'profile': 'standard',                  # 既定のエンコードプロファイル（--encode-profile で上書き）
+}
+
+# 音量正規化設定（ラウドネスを1回だけ測ってR2に保存し、変換時はその値で一定のゲインをかける）
+LOUDNESS_CONFIG = {
+    'enabled': True,
+    'key': 'youtube_loudness.json',   # R2上の測定結果（キー毎の ETag・積分ラウドネス・トゥルーピーク・LRA）
+    'target_i': -16.0,                # 目標の積分ラウドネス（LUFS）
+    'target_tp': -1.5,                # トゥルーピークの上限（dBTP）。超えるならゲインを抑える
+    'max_gain_db': 20.0,              # 小さすぎる録音でもノイズを持ち上げすぎない
+    'copy_tolerance_db': 0.5,         # 必要なゲインがこれ以下なら補正しない（AACならコピーできる）
+}
+
+# エンコードプロファイル
+# audio_gain: ラウドネスを測れなかったときの固定倍率
+# audio_copy_codecs: 音量補正が不要で元の音声がこのコーデックなら再エンコードせずコピー
+ENCODE_PROFILES = {
+    # 従来どおりの設定
+    'standard': {
+        'image_input': ['-loop', '1'],
+        'video': ['-c:v', 'libx264', '-b:v', '1M', '-r', '1'],
+        'audio_gain': 2.0,
+        'audio': ['-c:a', 'aac', '-b:a', '128k'],
+        'audio_copy_codecs': [],
+    },
+    # 静止画向け: 1fps で読み込み、長いGOP・極小ビットレート。変えるのは映像だけで、音量は standard と同じ
+    # （音量補正が要らないときだけ AAC をそのままコピー）
+    'fast': {
+        'image_input': ['-framerate', '1', '-loop', '1'],
+        'video': [
+            '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'stillimage',
+            '-r', '1', '-g', '600', '-keyint_min', '600', '-sc_threshold', '0',
+            '-crf', '30', '-maxrate', '64k', '-bufsize', '256k',
+        ],
+        'audio_gain': 2.0,
+        'audio': ['-c:a', 'aac', '-b:a', '128k'],
+        'audio_copy_codecs': ['aac'],
+    },
+}
+
+# 生成物キャッシュ設定（サムネイル・変換済み動画を再実行時に使い回す）
+CACHE_CONFIG = {
+    'enabled': True,
+    'dir': os.environ.get('YT_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.artifact_cache')),
+    'max_bytes': int(os.environ.get('YT_CACHE_MAX_BYTES', 2 * 1024 ** 3)),   # 超えたら古い順に削除
+    'r2_prefix': os.environ.get('YT_CACHE_R2_PREFIX', ''),                    # 例: 'youtube_cache/'（空ならR2にミラーしない）
+}
+
+# 公開履歴設定
+HISTORY_CONFIG = {
+    'snapshot_key': 'youtube_published.txt',      # スナップショット（従来どおり1行1ファイル名。旧版もそのまま読める）
+    'meta_key': 'youtube_published_meta.json',    # スナップショット内のファイルの付帯情報（動画ID・公開予定など）
+    'journal_key': 'youtube_published.journal',   # 追記ジャーナル（JSON Lines、スナップショット以降の記録）
+    'compact_every': 50,                          # ジャーナルがこの件数に達したらスナップショットに畳み込む
+    'max_retries': 5,                             # 条件付き書き込みが競合したときの再試行回数
+}
+
+# 条件付きPUT用のヘッダ（スレッド毎）。boto3 1.34 の put_object には IfMatch 引数が無いためイベントで差し込む
+_conditional_headers = threading.local()
+
+
+def _inject_conditional_headers(params, **kwargs):
+    headers = getattr(_conditional_headers, 'value', None)
+    if headers:
+        params['headers'].update(headers)
+
+
+def conditional_put(s3_client, bucket, key, body, if_match=None, if_none_match=None, content_type='text/plain'):
+    """
+    If-Match / If-None-Match 付きで put_object する
+    条件が成り立たず書き込まれなかった場合は None、成功時は新しい ETag を返す
+    """
+    from botocore.exceptions import ClientError
+
+    headers = {}
+    if if_match:
+        headers['If-Match'] = f'"{if_match}"'
+    if if_none_match:
+        headers['If-None-Match'] = if_none_match
+
+    _conditional_headers.value = headers
+    try:
+        response = s3_client.put_object(Bucket=bucket, Key=key, Body=body, ContentType=content_type)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            return None
+        raise
+    finally:
+        _conditional_headers.value = None
+    return response.get('ETag', '').strip('"')
+
+# 複数ノード協調設定（--coordinate 指定時: R2上のリース/枠オブジェクトでファイルと公開枠を取り合う）
+LEASE_CONFIG = {
+    'lease_prefix': 'youtube_leases/',   # ファイル毎のリース（処理中の印）
+    'slot_prefix': 'youtube_slots/',     # 公開枠毎の予約
+    'ttl_seconds': 30 * 60,              # 更新が途絶えたらこの時間で失効し、他ノードが引き継げる
+    'heartbeat_seconds': 5 * 60,         # リースを延長する間隔
+}
+
+# チャンネル照合設定（--reconcile 指定時）
+# channels.list / playlistItems.list / videos.list には youtube.readonly 以上のスコープが必要
+RECONCILE_CONFIG = {
+    'page_size': 50,                # playlistItems.list の1ページ件数（上限50）
+    'ids_per_request': 50,          # videos.list の1回で問い合わせる動画数（上限50）
+    'requests_per_batch': 50,       # 1回のバッチHTTPリクエストに詰める videos.list の数
+    'status_days': 30,              # 処理状況を確認する履歴の範囲（日）
+    'poll_timeout': 180,            # アップロード後に処理完了を待つ最大秒数（0 で待たない）
+    'poll_interval': 20,
+}
+
+# ストリーミング入出力設定
+# --stream-input: 音声をディスクに保存せず ffmpeg に直接渡す
+# --stream-output: 動画をディスクに書かず、ffmpeg の出力（fragmented MP4）を変換しながらアップロードする
+STREAM_CONFIG = {
+    'chunk_size': 256 * 1024,     # ffmpeg の stdin に書き込む単位
+    'head_bytes': 64 * 1024,      # MP4 の moov 位置判定のために先頭だけ読む量
+    'url_expires': 6 * 3600,      # HTTP 入力に使う署名付きURLの有効期限（秒）
+    'output_movflags': 'frag_keyframe+empty_moov+default_base_moof',   # 先頭に戻って書き直さない MP4
+    'output_buffer_bytes': 32 * 1024 * 1024,   # 未送信の出力をこれ以上溜めない（溜まったら ffmpeg を待たせる）
+}
+
+
+class EncodedStream:
+    """
+    ffmpeg の標準出力を再開可能アップロードに渡すバッファ
+    送信が確定していないバイトだけをメモリに持ち（再試行で送り直せるように）、
+    溜まりすぎたら読み込みを止めてパイプ越しに ffmpeg を待たせる
+    """
+
+    def __init__(self, config=STREAM_CONFIG):
+        self.config = config
+        self._cond = threading.Condition()
+        self._buffer = bytearray()
+        self._base = 0           # _buffer[0] の位置（送信確定済みのバイト数）
+        self._wanted = 0         # アップロード側が待っているバイト数
+        self._eof = False
+        self._closed = False
+        self._error = None
+
+    def fill(self, pipe):
+        """ffmpeg の標準出力を EOF まで読み込む（ffmpeg と同時に別スレッドで動かす）"""
+        try:
+            while True:
+                data = pipe.read1(self.config['chunk_size'])
+                if not data:
+                    break
+                with self._cond:
+                    while not self._closed and len(self._buffer) >= max(self.config['output_buffer_bytes'], self._wanted):
+                        self._cond.wait()
+                    if self._closed:
+                        break
+                    self._buffer += data
+                    self._cond.notify_all()
+        finally:
+            # 途中でやめた場合もパイプを閉じて ffmpeg を終わらせる
+            pipe.close()
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+    def fail(self, error):
+        """変換が失敗したことをアップロード側に伝える（close() の後は、読むのをやめたせいの失敗なので記録しない）"""
+        with self._cond:
+            if not self._closed:
+                self._error = error
+            self._cond.notify_all()
+
+    def error(self):
+        """変換の失敗（無ければ None）"""
+        with self._cond:
+            return self._error
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._buffer = bytearray()
+            self._cond.notify_all()
+
+    def size(self):
+        """全体のバイト数（出力が終わるまでは None）"""
+        with self._cond:
+            return self._base + len(self._buffer) if self._eof and self._error is None else None
+
+    def wait_ready(self, begin, length):
+        """
+        begin から length バイトより多く溜まるか、出力が終わるまで待つ
+        次のチャンクが最後かどうか（全体サイズを送れるか）をチャンクを送る前に確定させるため
+        """
+        with self._cond:
+            self._wanted = begin - self._base + length + 1
+            self._cond.notify_all()
+            while self._error is None and not self._eof and self._base + len(self._buffer) <= begin + length:
+                self._cond.wait()
+            if self._error is not None:
+                raise RuntimeError(f"動画変換が失敗しました: {self._error}") from self._error
+
+    def read(self, begin, length):
+        self.wait_ready(begin, length)
+        with self._cond:
+            if begin < self._base:
+                raise RuntimeError(f"送信済みとして破棄した位置 {begin} から読もうとしました（先頭 {self._base}）")
+            return bytes(self._buffer[begin - self._base:begin - self._base + length])
+
+    def release(self, offset):
+        """offset より前は送信確定済み。バッファから捨てる"""
+        with self._cond:
+            if offset > self._base:
+                del self._buffer[:offset - self._base]
+                self._base = offset
+                self._cond.notify_all()
+
+
+def streaming_media_upload(stream, chunksize, mimetype='video/mp4'):
+    """EncodedStream を googleapiclient の再開可能アップロードに渡す MediaUpload（サイズは出力が終わるまで不明）"""
+    from googleapiclient.http import MediaUpload
+
+    class StreamingMediaUpload(MediaUpload):
+        def __init__(self):
+            self._chunksize = chunksize
+
+        def chunksize(self):
+            return self._chunksize
+
+        def mimetype(self):
+            return mimetype
+
+        def size(self):
+            return stream.size()
+
+        def resumable(self):
+            return True
+
+        def has_stream(self):
+            return False
+
+        def getbytes(self, begin, length):
+            # 最後のチャンクが短くなれば、googleapiclient がそこで全体サイズを確定させる
+            return stream.read(begin, length)
+
+    return StreamingMediaUpload()
+
+# 計測設定
+METRICS_CONFIG = {
+    'prefix': 'youtube_uploader',   # Prometheus のメトリクス名プレフィックス
+    'profile_top': 25,              # --profile 時に保存するメモリ増加の上位件数
+}
+
+
+class RunMetrics:
+    """
+    ステージ毎の所要時間・バイト数・ビットレートを記録する
+    イベントは JSON Lines で逐次書き出し、終了時にサマリー表示と Prometheus テキストファイル出力を行う。
+    profile_dir を指定するとステージ毎に cProfile の統計と tracemalloc のメモリ増加を保存する
+    """
+
+    def __init__(self, events_path=None, prom_path=None, profile_dir=None, config=METRICS_CONFIG):
+        self.events_path = events_path
+        self.prom_path = prom_path
+        self.profile_dir = profile_dir
+        self.config = config
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = time.time()
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._seq = 0
+
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def bind(self, key):
+        """このスレッドで記録するイベントの既定キー（ファイル名）を設定"""
+        previous = getattr(self._local, 'key', None)
+        self._local.key = key
+        try:
+            yield
+        finally:
+            self._local.key = previous
+
+    @contextlib.contextmanager
+    def stage(self, name, key=None, nbytes=0):
+        """
+        ステージを計測する。with の中で event['bytes'] などを書き換えられる
+        例: with metrics.stage('download') as event: ...; event['bytes'] = size
+        """
+        event = {
+            'run_id': self.run_id,
+            'stage': name,
+            'key': key or getattr(self._local, 'key', None),
+            'bytes': nbytes,
+        }
+        profiler, snapshot = self._start_profile()
+        started = time.perf_counter()
+        event['status'] = 'ok'
+        try:
+            yield event
+        except BaseException:
+            event['status'] = 'error'
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            event['ts'] = time.time()
+            event['seconds'] = round(seconds, 6)
+            event['bitrate_bps'] = round(event['bytes'] * 8 / seconds) if seconds > 0 and event['bytes'] else 0
+            self._record(event, profiler, snapshot)
+
+    def _start_profile(self):
+        if not self.profile_dir:
+            return None, None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 他のステージ（別スレッド）がプロファイル中
+            profiler = None
+        return profiler, tracemalloc.take_snapshot()
+
+    def _record(self, event, profiler, snapshot):
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self.events.append(event)
+            if self.events_path:
+                with open(self.events_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+        if snapshot is None:
+            return
+        base = os.path.join(self.profile_dir, f"{seq:04d}-{event['stage']}")
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(base + '.prof')
+        diff = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+        with open(base + '.mem.txt', 'w', encoding='utf-8') as f:
+            f.write(f"# {event['stage']} {event['key']} {event['seconds']}s\n")
+            for stat in diff[:self.config['profile_top']]:
+                f.write(f"{stat}\n")
+
+    def summary(self):
+        """ステージ別の集計 {stage: {count, errors, seconds, bytes, bitrate_bps}}"""
+        stages = {}
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            total = stages.setdefault(event['stage'], {'count': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0})
+            total['count'] += 1
+            total['errors'] += event['status'] != 'ok'
+            total['seconds'] += event['seconds']
+            total['bytes'] += event['bytes']
+        for total in stages.values():
+            total['bitrate_bps'] = total['bytes'] * 8 / total['seconds'] if total['seconds'] and total['bytes'] else 0
+        return stages
+
+    def print_summary(self):
+        stages = self.summary()
+        if not stages:
+            return
+        print(f"📊 ステージ別計測 (run {self.run_id}):")
+        for name, total in stages.items():
+            rate = f", {total['bitrate_bps'] / 1e6:.2f}Mbps" if total['bitrate_bps'] else ''
+            errors = f", 失敗{total['errors']}" if total['errors'] else ''
+            print(f"  {name:<14} {total['count']:3d}回 {total['seconds']:8.2f}秒 {total['bytes'] / 1e6:8.1f}MB{rate}{errors}")
+
+    def write_prometheus(self, path=None):
+        """node_exporter の textfile collector 形式で書き出す（置き換えは rename で原子的に）"""
+        path = path or self.prom_path
+        if not path:
+            return
+        prefix = self.config['prefix']
+        lines = [
+            f"# HELP {prefix}_stage_seconds_total Time spent per stage in the last run.",
+            f"# TYPE {prefix}_stage_seconds_total counter",
+        ]
+        stages = self.summary()
+        for name, total in stages.items():
+            lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {total["seconds"]:.6f}')
+        lines += [f"# TYPE {prefix}_stage_bytes_total counter"]
+        for name, total in stages.items():
+            lines.append(f'{prefix}_stage_bytes_total{{stage="{name}"}} {total["bytes"]}')
+        lines += [f"# TYPE {prefix}_stage_events_total counter"]
+        for name, total in stages.items():
+            lines.append(f'{prefix}_stage_events_total{{stage="{name}",status="ok"}} {total["count"] - total["errors"]}')
+            lines.append(f'{prefix}_stage_events_total{{stage="{name}",status="error"}} {total["errors"]}')
+        lines += [f"# TYPE {prefix}_stage_bitrate_bps gauge"]
+        for name, total in stages.items():
+            lines.append(f'{prefix}_stage_bitrate_bps{{stage="{name}"}} {total["bitrate_bps"]:.0f}')
+        lines += [
+            f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+            f"{prefix}_last_run_timestamp_seconds {self.started:.0f}",
+            f"# TYPE {prefix}_last_run_duration_seconds gauge",
+            f"{prefix}_last_run_duration_seconds {time.time() - self.started:.3f}",
+        ]
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def finish(self):
+        """実行終了時のサマリー表示とエクスポート"""
+        self.print_summary()
+        self.write_prometheus()
+        if self.profile_dir:
+            tracemalloc.stop()
+            print(f"📊 プロファイルを {self.profile_dir} に保存しました")
+
+
+class R2Lister:
+    """
+    R2オブジェクト一覧取得（ページング・プレフィックス並列）
+    毎回全件を列挙する。StartAfter による差分列挙は、既存の最大キーより前に並ぶ新しいキー・変更・削除を
+    拾えないので使わない
+    """
+
+    def __init__(self, s3_client, bucket, config=LISTING_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+
+    def _prefixes(self):
+        return self.config['prefixes'] or ['']
+
+    def _list_prefix(self, prefix=''):
+        """1つのプレフィックスを継続トークンで最後まで列挙"""
+        params = {'Bucket': self.bucket, 'MaxKeys': self.config['page_size']}
+        if prefix:
+            params['Prefix'] = prefix
+
+        objects = {}
+        while True:
+            response = self.s3_client.list_objects_v2(**params)
+            for obj in response.get('Contents', []):
+                objects[obj['Key']] = {
+                    'etag': obj.get('ETag', '').strip('"'),
+                    'size': obj.get('Size', 0),
+                    'last_modified': obj['LastModified'].isoformat() if 'LastModified' in obj else None,
+                }
+            if not response.get('IsTruncated'):
+                return objects
+            params['ContinuationToken'] = response['NextContinuationToken']
+
+    def _list_all(self):
+        """全プレフィックスを列挙（複数あればスレッドで並列実行）"""
+        prefixes = self._prefixes()
+        if len(prefixes) == 1:
+            return self._list_prefix(prefixes[0])
+
+        objects = {}
+        with ThreadPoolExecutor(max_workers=self.config['max_workers']) as executor:
+            futures = [executor.submit(self._list_prefix, prefix) for prefix in prefixes]
+            for future in futures:
+                objects.update(future.result())
+        return objects
+
+    def scan(self):
+        """オブジェクト一覧を全件取得。戻り値: dict[key] = {'etag', 'size', 'last_modified'}"""
+        objects = self._list_all()
+        print(f"  ✓ 一覧取得: {len(objects)}件")
+        return objects
+
+
+class ArtifactCache:
+    """
+    生成物のコンテンツアドレス型キャッシュ
+    キーは元音声の ETag・設定のハッシュ・タイトルから作り、ローカルディレクトリに保存する。
+    r2_prefix を指定すると R2 にもミラーし、ローカルに無いときは R2 から取り戻す。
+    容量を超えたら最終アクセスが古いものから削除する（LRU）
+    """
+
+    def __init__(self, s3_client=None, bucket=None, config=CACHE_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self.root = Path(config['dir'])
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """任意の値（dict可）から安定したキーを作る"""
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, kind, key, ext):
+        return self.root / kind / f"{key}{ext}"
+
+    def _remote_key(self, kind, key, ext):
+        return f"{self.config['r2_prefix']}{kind}/{key}{ext}"
+
+    def get(self, kind, key, ext):
+        """キャッシュ済みファイルのパス（無ければ None）"""
+        from botocore.exceptions import ClientError
+
+        if not self.config['enabled'] or not key:
+            return None
+
+        path = self._path(kind, key, ext)
+        if path.exists():
+            # LRU 用に最終アクセス時刻として mtime を更新
+            os.utime(path)
+            return str(path)
+
+        if self.config['r2_prefix'] and self.s3_client:
+            tmp_path = path.with_suffix(path.suffix + '.part')
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                self.s3_client.download_file(self.bucket, self._remote_key(kind, key, ext), str(tmp_path))
+                os.replace(tmp_path, path)
+                print(f"  ✓ R2キャッシュから取得: {kind}")
+                return str(path)
+            except ClientError:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+        return None
+
+    def put(self, kind, key, src_path, ext):
+        """
+        ファイルをキャッシュに移して（src_path は無くなる）キャッシュ側のパスを返す
+        同じファイルシステムならコピーせずに名前を変えるだけ
+        """
+        if not self.config['enabled'] or not key:
+            return src_path
+
+        path = self._path(kind, key, ext)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(path.suffix + f'.{threading.get_ident()}.part')
+        shutil.move(src_path, tmp_path)
+        os.replace(tmp_path, path)
+
+        if self.config['r2_prefix'] and self.s3_client:
+            try:
+                self.s3_client.upload_file(str(path), self.bucket, self._remote_key(kind, key, ext))
+            except Exception as e:
+                print(f"  ⚠️ R2キャッシュ保存エラー: {e}")
+
+        self.evict()
+        return str(path)
+
+    def discard(self, kind, key, ext):
+        """もう使わないエントリをローカルと R2 のミラーから消す（公開済みの動画など）"""
+        if not self.config['enabled'] or not key:
+            return
+        self._path(kind, key, ext).unlink(missing_ok=True)
+        if self.config['r2_prefix'] and self.s3_client:
+            try:
+                self.s3_client.delete_object(Bucket=self.bucket, Key=self._remote_key(kind, key, ext))
+            except Exception as e:
+                print(f"  ⚠️ R2キャッシュ削除エラー: {e}")
+
+    def evict(self):
+        """合計サイズが上限を超えていれば古いものから削除"""
+        with self._lock:
+            if not self.root.exists():
+                return
+            files = []
+            for path in self.root.rglob('*'):
+                if path.is_file() and not path.name.endswith('.part'):
+                    stat = path.stat()
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.config['max_bytes']:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+
+
+class PublishedHistory:
+    """
+    公開履歴（スナップショット + 追記ジャーナル）
+    アップロード毎にはジャーナルへ小さなレコードを1行足すだけにし、
+    一定件数ごとにスナップショットへ畳み込む。書き込みはすべて ETag 条件付きで、
+    別の実行と競合したら読み直して再試行する。
+    スナップショットはファイル名だけの従来形式のまま書き、付帯情報は別オブジェクト（meta_key）に置く
+    """
+
+    def __init__(self, s3_client, bucket, config=HISTORY_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self._lock = threading.Lock()
+        self.published = set()
+        self.records = {}
+        self.failures = {}       # 未公開ファイルの失敗 {count, stage, last_error, last_at, etag}
+        self.released = set()    # --release で隔離を解除したファイル
+        self.snapshot_etag = None
+        self.meta_etag = None
+        self.journal_etag = None
+        self.journal_lines = []
+
+    def _get(self, key, etag=None):
+        """
+        (本文, ETag)。オブジェクトが無ければ (None, None)
+        etag を渡すと条件付きGETになり、変わっていなければ本文を読まずに (None, etag)
+        """
+        from botocore.exceptions import ClientError
+
+        params = {'Bucket': self.bucket, 'Key': key}
+        if etag:
+            params['IfNoneMatch'] = f'"{etag}"'
+        try:
+            response = self.s3_client.get_object(**params)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == "NoSuchKey":
+                return None, None
+            if code in ('304', 'NotModified'):
+                return None, etag
+            raise
+        return response['Body'].read().decode('utf-8'), response['ETag'].strip('"')
+
+    def _apply(self, record):
+        """ジャーナル/スナップショットの1レコードを反映"""
+        op = record.get('op', 'published')
+        filename = record['file']
+        if op == 'published':
+            self.published.add(filename)
+            self.records[filename] = {k: v for k, v in record.items() if k not in ('op', 'file')}
+            self.failures.pop(filename, None)
+        elif op == 'failure':
+            entry = self.failures.get(filename)
+            if entry is None or entry.get('etag') != record.get('etag'):
+                # 元ファイルが差し替えられていたら数え直す
+                entry = {'count': 0}
+            entry.update(
+                count=entry['count'] + 1,
+                stage=record.get('stage'),
+                last_error=record.get('error'),
+                last_at=record.get('at', 0),
+                etag=record.get('etag'),
+            )
+            self.failures[filename] = entry
+        elif op == 'release':
+            self.failures.pop(filename, None)
+            self.released.add(filename)
+
+    def _read_meta(self):
+        """スナップショット内のファイルの付帯情報 {ファイル名: dict}（無い・壊れていれば空）"""
+        content, self.meta_etag = self._get(self.config['meta_key'])
+        try:
+            return json.loads(content) if content else {}
+        except ValueError:
+            print("  ⚠️ 履歴の付帯情報が壊れているため無視します")
+            return {}
+
+    def _parse_snapshot(self, content):
+        meta = self._read_meta()
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            # 「ファイル名\t付帯情報JSON」の行（この形式で書いた版のスナップショット）も読めるようにしておく
+            filename, _, inline = line.partition('\t')
+            filename = filename.strip()
+            record = dict(meta.get(filename) or (json.loads(inline) if inline else {}))
+            record['file'] = filename
+            self._apply(record)
+
+    def _parse_journal(self, content):
+        # 失敗台帳はジャーナルにしかないので毎回数え直す（読み直しで二重に数えない）
+        self.failures = {}
+        self.released = set()
+        lines = []
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            try:
+                self._apply(json.loads(line))
+                lines.append(line)
+            except ValueError:
+                print(f"  ⚠️ 履歴ジャーナルの壊れた行を無視: {line[:80]}")
+        return lines
+
+    def _reload_journal(self):
+        content, self.journal_etag = self._get(self.config['journal_key'])
+        self.journal_lines = self._parse_journal(content or '')
+
+    def load(self):
+        """スナップショットとジャーナルを読み込んで公開済みファイル名のセットを返す"""
+        with self._lock:
+            content, self.snapshot_etag = self._get(self.config['snapshot_key'])
+            if content is not None:
+                self._parse_snapshot(content)
+            self._reload_journal()
+        return self.published
+
+    def _reload_snapshot_if_changed(self):
+        """
+        スナップショットが他の実行に畳み込まれていたら読み直す（条件付きGET）。読み直したら True
+        畳み込まれたレコードはジャーナルから消えているので、ジャーナルだけ読み直すと取りこぼす
+        """
+        content, etag = self._get(self.config['snapshot_key'], self.snapshot_etag)
+        if content is None and etag == self.snapshot_etag:
+            return False
+        self.snapshot_etag = etag
+        if content is not None:
+            self._parse_snapshot(content)
+        return True
+
+    def refresh(self):
+        """
+        他の実行による更新を取り込む（常駐モードの周回毎に呼ぶ）
+        条件付きGETなので、変わっていなければ本文は転送されない。更新があれば True
+        """
+        with self._lock:
+            if self._reload_snapshot_if_changed():
+                # 畳み込みされた → ジャーナルも読み直す
+                self._reload_journal()
+                return True
+
+            content, etag = self._get(self.config['journal_key'], self.journal_etag)
+            if content is None and etag == self.journal_etag:
+                return False
+            self.journal_etag = etag
+            self.journal_lines = self._parse_journal(content or '')
+            return True
+
+    def _append(self, record):
+        """ジャーナルに1行追記（競合したら読み直して再試行）"""
+        line = json.dumps(record, ensure_ascii=False)
+        for _ in range(self.config['max_retries']):
+            body = '\n'.join(self.journal_lines + [line]) + '\n'
+            etag = conditional_put(
+                self.s3_client, self.bucket, self.config['journal_key'], body.encode('utf-8'),
+                if_match=self.journal_etag,
+                if_none_match=None if self.journal_etag else '*'
+            )
+            if etag is not None:
+                self.journal_etag = etag
+                self.journal_lines.append(line)
+                self._apply(record)
+                return
+            print("  ℹ️ 履歴が他の実行で更新されていたため読み直します")
+            self._reload_snapshot_if_changed()
+            self._reload_journal()
+        raise RuntimeError("履歴ジャーナルの更新が競合し続けたため保存できませんでした")
+
+    def compact(self):
+        """
+        ジャーナルの内容をスナップショットに畳み込み、ジャーナルを空にする
+        順序はスナップショット → 付帯情報 → ジャーナル。途中で止まってもジャーナルに記録が残る
+        """
+        lines = sorted(self.published)
+        etag = conditional_put(
+            self.s3_client, self.bucket, self.config['snapshot_key'], '\n'.join(lines).encode('utf-8'),
+            if_match=self.snapshot_etag,
+            if_none_match=None if self.snapshot_etag else '*'
+        )
+        if etag is None:
+            # 他の実行が先に畳み込んだ。ジャーナルはそのまま残し（重複しても無害）、
+            # 古い ETag のままだと次回以降も畳み込めないので読み直しておく
+            print("  ℹ️ 履歴スナップショットは他の実行が更新済みです")
+            self._reload_snapshot_if_changed()
+            self._reload_journal()
+            return
+        self.snapshot_etag = etag
+
+        meta = {filename: self.records[filename] for filename in lines if self.records.get(filename)}
+        meta_etag = conditional_put(
+            self.s3_client, self.bucket, self.config['meta_key'],
+            json.dumps(meta, ensure_ascii=False).encode('utf-8'),
+            if_match=self.meta_etag,
+            if_none_match=None if self.meta_etag else '*',
+            content_type='application/json'
+        )
+        if meta_etag is None:
+            # 他の実行が先に書いた。付帯情報はジャーナルに残っているので、ジャーナルは空にしない
+            print("  ℹ️ 履歴の付帯情報は他の実行が更新済みです（ジャーナルは残します）")
+            return
+        self.meta_etag = meta_etag
+
+        # 失敗台帳（未公開ファイルの failure / release）はスナップショットに入れず、ジャーナルに残す
+        kept = []
+        for line in self.journal_lines:
+            record = json.loads(line)
+            if record.get('op') in ('failure', 'release') and record['file'] not in self.published:
+                kept.append(line)
+        body = ('\n'.join(kept) + '\n').encode('utf-8') if kept else b''
+
+        # ここで競合しても、ジャーナルに残ったレコードはスナップショットと重複するだけなので問題ない
+        journal_etag = conditional_put(
+            self.s3_client, self.bucket, self.config['journal_key'], body, if_match=self.journal_etag
+        )
+        if journal_etag is not None:
+            self.journal_etag = journal_etag
+            self.journal_lines = kept
+        print(f"  🗜️ 履歴を畳み込みました: {len(lines)}件")
+
+    def record_failure(self, filename, stage, error, etag=None):
+        """処理失敗を記録（失敗台帳）"""
+        record = {'op': 'failure', 'file': filename, 'at': int(time.time()), 'stage': stage, 'error': str(error)[:300]}
+        if etag:
+            record['etag'] = etag
+        with self._lock:
+            self._append(record)
+        return self.failures[filename]
+
+    def release(self, filename):
+        """隔離を解除（失敗回数も消す）"""
+        with self._lock:
+            self._append({'op': 'release', 'file': filename, 'at': int(time.time())})
+
+    def failure_status(self, filename, etag=None, config=FAILURE_CONFIG):
+        """
+        ('ok' | 'backoff' | 'quarantined', 失敗情報)
+        IGNORE_FILES のファイルは、解除されるまで隔離済みとして扱う
+        """
+        entry = self.failures.get(filename)
+        if entry is None:
+            if filename in IGNORE_FILES and filename not in self.released:
+                return 'quarantined', {'count': None, 'stage': None, 'last_error': '除外リスト (IGNORE_FILES)', 'last_at': None}
+            return 'ok', None
+        if etag and entry.get('etag') and entry['etag'] != etag:
+            # 元ファイルが差し替えられた → もう一度試す
+            return 'ok', entry
+        if entry['count'] >= config['quarantine_after']:
+            return 'quarantined', entry
+        wait = min(config['backoff_max_hours'], config['backoff_base_hours'] * 2 ** (entry['count'] - 1)) * 3600
+        if time.time() < entry['last_at'] + wait:
+            return 'backoff', entry
+        return 'ok', entry
+
+    def quarantined(self):
+        """隔離中のファイル {ファイル名: 失敗情報}（IGNORE_FILES 由来も含む）"""
+        names = (set(self.failures) | set(IGNORE_FILES)) - self.published
+        result = {}
+        for filename in sorted(names):
+            status, entry = self.failure_status(filename)
+            if status == 'quarantined':
+                result[filename] = entry
+        return result
+
+    def record(self, filename, **meta):
+        """公開済みとして記録"""
+        record = {'op': 'published', 'file': filename, 'at': int(time.time())}
+        record.update({k: v for k, v in meta.items() if v is not None})
+        with self._lock:
+            self._append(record)
+            if len(self.journal_lines) >= self.config['compact_every']:
+                self.compact()
+
+
+class UploadSessionStore:
+    """
+    YouTube の再開可能アップロードのセッションURIと送信済みバイト数をR2に保存する
+    プロセスが落ちても、次回同じ動画（同じキャッシュキー）なら続きから送信できる
+    """
+
+    def __init__(self, s3_client, bucket, config=UPLOAD_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self._lock = threading.Lock()
+        self._sessions = None
+
+    def _load(self):
+        from botocore.exceptions import ClientError
+
+        if self._sessions is not None:
+            return
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.config['session_key'])
+            sessions = json.loads(response['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] != "NoSuchKey":
+                print(f"  ⚠️ アップロード再開情報の取得エラー: {e}")
+            sessions = {}
+        except ValueError:
+            sessions = {}
+
+        # 失効したセッションは捨てる
+        max_age = self.config['session_max_age_hours'] * 3600
+        self._sessions = {
+            session_id: entry for session_id, entry in sessions.items()
+            if time.time() - entry.get('created_at', 0) < max_age
+        }
+
+    def _save(self):
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.config['session_key'],
+                Body=json.dumps(self._sessions, ensure_ascii=False).encode('utf-8'),
+                ContentType='application/json'
+            )
+        except Exception as e:
+            print(f"  ⚠️ アップロード再開情報の保存エラー: {e}")
+
+    def get(self, session_id):
+        if not session_id:
+            return None
+        with self._lock:
+            self._load()
+            return self._sessions.get(session_id)
+
+    def update(self, session_id, **fields):
+        if not session_id:
+            return
+        with self._lock:
+            self._load()
+            entry = self._sessions.setdefault(session_id, {'created_at': time.time()})
+            entry.update(fields)
+            self._save()
+
+    def pending(self):
+        """再開待ちのセッション数"""
+        with self._lock:
+            self._load()
+            return len(self._sessions)
+
+    def drop(self, session_id):
+        if not session_id:
+            return
+        with self._lock:
+            self._load()
+            if self._sessions.pop(session_id, None) is not None:
+                self._save()
+
+
+class QuotaLedger:
+    """
+    YouTube API クォータのトークンバケット
+    バケットは太平洋時間の0時に daily_limit まで満たされ、API呼び出し毎に費用分を取り出す。
+    当日の消費量はR2に保存し、別の実行とは ETag 条件付き書き込みで合算する
+    """
+
+    def __init__(self, s3_client, bucket, config=QUOTA_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self._lock = threading.Lock()
+        self._state = None
+        self._etag = None
+
+    def _today(self):
+        from zoneinfo import ZoneInfo
+        return datetime.now(ZoneInfo(self.config['timezone'])).date().isoformat()
+
+    def _empty(self):
+        return {'day': self._today(), 'used': 0, 'calls': {}, 'exhausted': False}
+
+    def _load(self):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.config['ledger_key'])
+            # 本文が壊れていても、上書きの条件には今の ETag を使う
+            self._etag = response['ETag'].strip('"')
+            state = json.loads(response['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] != "NoSuchKey":
+                raise
+            state, self._etag = None, None
+        except ValueError:
+            state = None
+
+        # 日付が変わっていればバケットは満タンに戻っている
+        if not state or state.get('day') != self._today():
+            state = self._empty()
+        self._state = state
+
+    def _ensure_loaded(self):
+        if self._state is None:
+            self._load()
+        elif self._state['day'] != self._today():
+            self._state = self._empty()
+
+    def _save(self, update):
+        """update(state) を適用して保存（競合したら読み直して適用し直す）"""
+        for _ in range(self.config['max_retries']):
+            self._ensure_loaded()
+            update(self._state)
+            etag = conditional_put(
+                self.s3_client, self.bucket, self.config['ledger_key'],
+                json.dumps(self._state, ensure_ascii=False).encode('utf-8'),
+                if_match=self._etag,
+                if_none_match=None if self._etag else '*',
+                content_type='application/json'
+            )
+            if etag is not None:
+                self._etag = etag
+                return
+            self._load()
+        print("  ⚠️ クォータ記録の更新が競合し続けたため保存できませんでした")
+
+    def cost(self, api, count=1):
+        return self.config['costs'][api] * count
+
+    @property
+    def used(self):
+        with self._lock:
+            self._ensure_loaded()
+            return self._state['used']
+
+    def available(self):
+        """今日あと使えるユニット数（バケットの残量）"""
+        with self._lock:
+            self._ensure_loaded()
+            if self._state['exhausted']:
+                return 0
+            return max(0, self.config['daily_limit'] - self.config['reserve'] - self._state['used'])
+
+    def per_file_cost(self):
+        """1ファイル公開あたりの費用（動画アップロード + サムネイル設定）"""
+        return self.cost('videos.insert') + self.cost('thumbnails.set')
+
+    def plan(self, costs):
+        """
+        今日のクォータで公開まで進められるファイル数
+        costs はファイル毎の残りの費用（先頭から順に、残量に収まるところまで）
+        """
+        remaining = self.available()
+        allowed = 0
+        for cost in costs:
+            if cost > remaining:
+                break
+            remaining -= cost
+            allowed += 1
+        return allowed
+
+    def charge(self, api, count=1):
+        """API呼び出し分を消費として記録（失敗した呼び出しも課金されるので呼び出し前に記録する）"""
+        units = self.cost(api, count)
+
+        def update(state):
+            state['used'] += units
+            state['calls'][api] = state['calls'].get(api, 0) + count
+
+        with self._lock:
+            self._save(update)
+
+    def exhaust(self):
+        """quotaExceeded を受けた。今日はもう使えないものとして記録する"""
+        def update(state):
+            state['exhausted'] = True
+
+        with self._lock:
+            self._save(update)
+
+    def reset_time(self):
+        """次にクォータが戻る時刻（日本時間）"""
+        from zoneinfo import ZoneInfo
+        tz = ZoneInfo(self.config['timezone'])
+        tomorrow = datetime.now(tz).date() + timedelta(days=1)
+        reset = datetime(tomorrow.year, tomorrow.month, tomorrow.day, tzinfo=tz)
+        return reset.astimezone(ZoneInfo('Asia/Tokyo'))
+
+
+class LeaseManager:
+    """
+    R2上のリースオブジェクトによる複数ノード間の排他
+    取得は If-None-Match: * の条件付きPUT、失効したリースの引き継ぎと延長は If-Match で行うので、
+    同じファイル・同じ公開枠を2つのノードが同時に持つことはない。
+    保持中のリースはハートビートスレッドが定期的に延長する
+    """
+
+    def __init__(self, s3_client, bucket, owner=None, config=LEASE_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self.owner = owner or f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._held = {}      # R2キー → (ETag, 本文dict)
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    @staticmethod
+    def _digest(name):
+        return hashlib.sha256(name.encode('utf-8')).hexdigest()[:32]
+
+    def _get(self, key):
+        """(本文dict, ETag)。無ければ (None, None)"""
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] == "NoSuchKey":
+                return None, None
+            raise
+        try:
+            body = json.loads(response['Body'].read().decode('utf-8'))
+        except ValueError:
+            body = {}
+        return body, response['ETag'].strip('"')
+
+    def _put(self, key, body, if_match=None):
+        return conditional_put(
+            self.s3_client, self.bucket, key, json.dumps(body, ensure_ascii=False).encode('utf-8'),
+            if_match=if_match,
+            if_none_match=None if if_match else '*',
+            content_type='application/json'
+        )
+
+    def _body(self, **fields):
+        body = {'owner': self.owner, 'expires_at': time.time() + self.config['ttl_seconds']}
+        body.update(fields)
+        return body
+
+    def _claim(self, key, is_stale, **fields):
+        """
+        key を取得する。既にあれば is_stale(本文) が真のときだけ ETag 条件付きで引き継ぐ
+        取得できたら True
+        """
+        body = self._body(**fields)
+        etag = self._put(key, body)
+        if etag is None:
+            current, current_etag = self._get(key)
+            if current is None:
+                # 確認する間に消えた → もう一度新規作成を試す
+                etag = self._put(key, body)
+            elif current.get('owner') == self.owner or is_stale(current):
+                etag = self._put(key, body, if_match=current_etag)
+        if etag is None:
+            return False
+        with self._lock:
+            self._held[key] = (etag, body)
+        return True
+
+    def _expired(self, body):
+        return body.get('expires_at', 0) < time.time()
+
+    def acquire(self, filename):
+        """ファイルのリースを取る（他ノードが有効なリースを持っていれば False）"""
+        return self._claim(self.config['lease_prefix'] + self._digest(filename), self._expired, file=filename)
+
+    def holds(self, filename):
+        with self._lock:
+            return self.config['lease_prefix'] + self._digest(filename) in self._held
+
+    def release(self, filename):
+        self._release(self.config['lease_prefix'] + self._digest(filename))
+
+    def _release(self, key):
+        with self._lock:
+            held = self._held.pop(key, None)
+        if held is None:
+            return
+        current, current_etag = self._get(key)
+        # 失効後に他ノードが引き継いでいたら消さない
+        if current_etag == held[0]:
+            self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+
+    def claim_slot(self, start, filename, published):
+        """
+        start 以降で空いている公開枠を予約して番号を返す
+        公開済みの枠と、他ノードが有効に予約中の枠は飛ばす。失効した未完了の予約は引き継ぐ
+        """
+        def is_stale(body):
+            return not body.get('done') and self._expired(body) and body.get('file') not in published
+
+        slot = start
+        while not self._claim(f"{self.config['slot_prefix']}{slot:06d}", is_stale, file=filename):
+            slot += 1
+        return slot
+
+    def complete_slot(self, slot, video_id):
+        """公開枠を使用済みにする（以後は失効しない）"""
+        key = f"{self.config['slot_prefix']}{slot:06d}"
+        with self._lock:
+            held = self._held.pop(key, None)
+        if held is None:
+            return
+        body = dict(held[1], done=True, video_id=video_id, expires_at=None)
+        if self._put(key, body, if_match=held[0]) is None:
+            print(f"  ⚠️ 公開枠 {slot} の予約が他ノードに引き継がれていました")
+
+    def release_slot(self, slot):
+        """アップロードに失敗した公開枠を空ける"""
+        self._release(f"{self.config['slot_prefix']}{slot:06d}")
+
+    def _renew_all(self):
+        with self._lock:
+            held = dict(self._held)
+        for key, (etag, body) in held.items():
+            body = dict(body, expires_at=time.time() + self.config['ttl_seconds'])
+            new_etag = self._put(key, body, if_match=etag)
+            with self._lock:
+                if key not in self._held:
+                    continue
+                if new_etag is None:
+                    # 失効して他ノードに取られた。以後このリースでは作業しない
+                    print(f"  ⚠️ リースを失いました: {body.get('file')}")
+                    del self._held[key]
+                else:
+                    self._held[key] = (new_etag, body)
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.config['heartbeat_seconds']):
+            try:
+                self._renew_all()
+            except Exception as e:
+                print(f"  ⚠️ リース延長エラー: {e}")
+
+    def start(self):
+        if self._heartbeat is None:
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='lease-heartbeat', daemon=True)
+            self._heartbeat.start()
+
+    def stop(self):
+        """ハートビートを止め、残っているリース・予約をすべて手放す"""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        with self._lock:
+            keys = list(self._held)
+        for key in keys:
+            try:
+                self._release(key)
+            except Exception as e:
+                print(f"  ⚠️ リース解放エラー: {e}")
+
+
+class ChannelReconciler:
+    """
+    チャンネルのアップロード済み動画の取得と、処理状況のまとめて確認
+    アップロード再生リストをページ送りで読み、videos.list は50件ずつ BatchHttpRequest に詰めて
+    数百本の確認でも数回のHTTPリクエスト・数ユニットのクォータで済ませる
+    """
+
+    # 処理が終わったとみなす状態
+    FINAL_UPLOAD_STATUSES = ('processed', 'failed', 'rejected', 'deleted')
+
+    def __init__(self, youtube, quota, config=RECONCILE_CONFIG):
+        self.youtube = youtube
+        self.quota = quota
+        self.config = config
+
+    def uploads_playlist(self):
+        """チャンネルのアップロード再生リストID"""
+        self.quota.charge('channels.list')
+        response = self.youtube.channels().list(part='contentDetails', mine=True).execute()
+        items = response.get('items', [])
+        if not items:
+            raise RuntimeError("チャンネルが見つかりません")
+        return items[0]['contentDetails']['relatedPlaylists']['uploads']
+
+    def list_uploads(self):
+        """アップロード済み動画 [{'video_id', 'title', 'published_at'}]（新しい順）"""
+        playlist_id = self.uploads_playlist()
+        videos = []
+        page_token = None
+        while True:
+            self.quota.charge('playlistItems.list')
+            response = self.youtube.playlistItems().list(
+                part='snippet',
+                playlistId=playlist_id,
+                maxResults=self.config['page_size'],
+                pageToken=page_token
+            ).execute()
+            for item in response.get('items', []):
+                snippet = item['snippet']
+                videos.append({
+                    'video_id': snippet['resourceId']['videoId'],
+                    'title': snippet.get('title', ''),
+                    'published_at': snippet.get('publishedAt'),
+                })
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return videos
+
+    def fetch_status(self, video_ids, part='status,processingDetails'):
+        """動画ID → videos.list の item。見つからない（削除済み）動画は含まれない"""
+        video_ids = list(dict.fromkeys(video_ids))
+        found = {}
+        errors = []
+
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+                return
+            for item in response.get('items', []):
+                found[item['id']] = item
+
+        step = self.config['ids_per_request']
+        chunks = [video_ids[i:i + step] for i in range(0, len(video_ids), step)]
+        per_batch = self.config['requests_per_batch']
+        for i in range(0, len(chunks), per_batch):
+            batch = self.youtube.new_batch_http_request(callback=on_response)
+            for chunk in chunks[i:i + per_batch]:
+                batch.add(self.youtube.videos().list(part=part, id=','.join(chunk), maxResults=step))
+            self.quota.charge('videos.list', len(chunks[i:i + per_batch]))
+            batch.execute()
+            if errors:
+                raise errors[0]
+        return found
+
+    @staticmethod
+    def describe(item):
+        """処理状況の要約 (完了したか, 表示用文字列)"""
+        status = item.get('status', {})
+        details = item.get('processingDetails', {})
+        upload_status = status.get('uploadStatus', '?')
+        processing = details.get('processingStatus', '?')
+        text = f"upload={upload_status} processing={processing}"
+        if details.get('thumbnailsAvailability'):
+            text += f" thumbnails={details['thumbnailsAvailability']}"
+        reason = status.get('failureReason') or status.get('rejectionReason')
+        if reason:
+            text += f" ({reason})"
+        done = upload_status in ChannelReconciler.FINAL_UPLOAD_STATUSES and processing != 'processing'
+        return done, text
+
+    def wait_for_processing(self, video_ids):
+        """処理完了（または失敗）まで videos.list をまとめて問い合わせて待つ。未完了の動画IDを返す"""
+        pending = list(video_ids)
+        deadline = time.monotonic() + self.config['poll_timeout']
+        while pending:
+            items = self.fetch_status(pending)
+            still = []
+            for video_id in pending:
+                item = items.get(video_id)
+                if item is None:
+                    print(f"  ⚠️ {video_id}: 動画が見つかりません（削除済み？）")
+                    continue
+                done, text = self.describe(item)
+                if done:
+                    print(f"  ✓ {video_id}: {text}")
+                else:
+                    still.append(video_id)
+            pending = still
+            if not pending or time.monotonic() + self.config['poll_interval'] > deadline:
+                break
+            print(f"  ⏳ 処理待ち {len(pending)}本...")
+            time.sleep(self.config['poll_interval'])
+        for video_id in pending:
+            print(f"  ⏳ {video_id}: まだ処理中です")
+        return pending
+
+
+class Prefetcher:
+    """
+    処理順に並んだファイルを、バックグラウンドで先にダウンロードしておく
+    先読み本数（lookahead）と手元に置く合計サイズ（disk_budget）の両方で抑え、
+    take() で取り出されるたびに次のファイルを取りに行く
+    """
+
+    def __init__(self, download, keys, sizes, workdir, metrics=None, config=DOWNLOAD_CONFIG):
+        self.download = download
+        self.keys = list(keys)
+        self.sizes = sizes
+        self.workdir = workdir
+        self.metrics = metrics
+        self.config = config
+        self._cond = threading.Condition()
+        self._state = {}        # key → 'pending' / 'ready' / 'taken' / 'discarded'
+        self._paths = {}
+        self._errors = {}
+        self._held_bytes = 0    # ダウンロード中・取り出し待ちの合計サイズ
+        self._held_count = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _has_room(self, size):
+        if self._held_count == 0:
+            # 予算より大きいファイルでも1本なら取りに行く
+            return True
+        return (self._held_count < self.config['lookahead']
+                and self._held_bytes + size <= self.config['disk_budget'])
+
+    def _run(self):
+        for index, key in enumerate(self.keys):
+            size = self.sizes.get(key, 0)
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopped or self._state.get(key) or self._has_room(size))
+                if self._stopped:
+                    return
+                if self._state.get(key):
+                    # 先読みする前に取り出された / 不要になった
+                    continue
+                self._state[key] = 'pending'
+                self._held_bytes += size
+                self._held_count += 1
+
+            path = os.path.join(self.workdir, f"{index:05d}_{os.path.basename(key)}")
+            try:
+                if self.metrics:
+                    with self.metrics.stage('prefetch', key=key, nbytes=size):
+                        self.download(key, path)
+                else:
+                    self.download(key, path)
+            except Exception as e:
+                self._errors[key] = e
+
+            with self._cond:
+                self._paths[key] = path
+                if self._state[key] == 'pending':
+                    self._state[key] = 'ready'
+                else:
+                    # ダウンロード中に不要になった
+                    self._release(key)
+                self._cond.notify_all()
+
+    def _release(self, key):
+        path = self._paths.pop(key, None)
+        if path and os.path.exists(path):
+            os.remove(path)
+        self._held_bytes -= self.sizes.get(key, 0)
+        self._held_count -= 1
+
+    def take(self, key, dest_path):
+        """
+        先読み済みのファイルを dest_path に移す（未着ならダウンロード完了まで待つ）
+        先読み対象外、または先読みが始まっていなければ False（呼び出し側で直接ダウンロードする）
+        """
+        with self._cond:
+            if key not in self.keys or self._stopped:
+                return False
+            if self._state.get(key) is None:
+                # まだ取りに行っていない → 先読みに任せず直接ダウンロードさせる
+                self._state[key] = 'taken'
+                self._cond.notify_all()
+                return False
+            self._cond.wait_for(lambda: self._state[key] != 'pending')
+            if self._state[key] != 'ready':
+                return False
+            self._state[key] = 'taken'
+            error = self._errors.pop(key, None)
+            # ファイルは呼び出し側に渡すので、消さずに枠だけ空ける
+            path = self._paths.pop(key, None)
+            self._release(key)
+            self._cond.notify_all()
+
+        if error is not None:
+            raise error
+        shutil.move(path, dest_path)
+        return True
+
+    def discard(self, key):
+        """不要になった（キャッシュ命中・中止など）ファイルを捨てて枠を空ける"""
+        with self._cond:
+            state = self._state.get(key)
+            if state is None:
+                self._state[key] = 'discarded'
+            elif state == 'ready':
+                self._state[key] = 'discarded'
+                self._release(key)
+            elif state == 'pending':
+                # ダウンロード完了時に捨てる
+                self._state[key] = 'discarded'
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            for key, state in list(self._state.items()):
+                if state == 'ready':
+                    self._state[key] = 'discarded'
+                    self._release(key)
+
+
+class FileStateStore:
+    """
+    ファイル毎の処理段階（encoded → uploaded → thumbnail_set → recorded）をR2のJSONに保存する
+    encoded は変換済み動画のキャッシュキーを残し、次回は設定が変わっていても同じ動画を送る（再開情報も使える）。
+    動画IDと公開予定は uploaded の時点で残すので、サムネイル設定や履歴記録で失敗しても
+    次回は動画を送り直さずに残りの段階だけを行う。書き込みは ETag 条件付きで他の実行と合算する
+    """
+
+    def __init__(self, s3_client, bucket, config=FILE_STATE_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self._lock = threading.Lock()
+        self._states = None
+        self._etag = None
+
+    def _load(self):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.config['key'])
+            self._states = json.loads(response['Body'].read().decode('utf-8'))
+            self._etag = response['ETag'].strip('"')
+        except ClientError as e:
+            if e.response['Error']['Code'] != "NoSuchKey":
+                raise
+            self._states, self._etag = {}, None
+        except ValueError:
+            print("  ⚠️ 進捗ファイルが壊れているため読み直せません（空として扱います）")
+            self._states = {}
+
+    def _ensure_loaded(self):
+        if self._states is None:
+            self._load()
+
+    @staticmethod
+    def reached(entry, state):
+        """entry が state の段階まで済んでいるか"""
+        current = (entry or {}).get('state')
+        return current in FILE_STATES and FILE_STATES.index(current) >= FILE_STATES.index(state)
+
+    def get(self, key):
+        with self._lock:
+            self._ensure_loaded()
+            return dict(self._states.get(key, {}))
+
+    def advance(self, key, state, **fields):
+        """key を state に進めて保存。recorded に達したら記録を消す（以後は公開履歴が正）"""
+        def update(states):
+            if state == 'recorded':
+                states.pop(key, None)
+                return True
+            entry = states.setdefault(key, {})
+            entry.update({k: v for k, v in fields.items() if v is not None})
+            entry['state'] = state
+            entry['updated_at'] = int(time.time())
+            return True
+
+        self._update(update)
+
+    def forget(self, keys):
+        """
+        uploaded に達していない記録を消す（変換済み動画を指しているだけなので、消しても作り直せる）
+        uploaded 以降は動画と公開枠が実在するので消さない
+        """
+        keys = set(keys)
+
+        def update(states):
+            stale = [key for key in keys if key in states and not self.reached(states[key], 'uploaded')]
+            for key in stale:
+                del states[key]
+            return bool(stale)
+
+        self._update(update)
+
+    def prune(self, objects):
+        """
+        元ファイルが消えたか差し替わった（ETagが違う）キーの uploaded 前の記録と、
+        今は使わない段階（旧版の downloaded）の記録を消す
+        """
+        with self._lock:
+            self._ensure_loaded()
+            stale = [
+                key for key, entry in self._states.items()
+                if entry.get('state') not in FILE_STATES
+                or (not self.reached(entry, 'uploaded') and objects.get(key, {}).get('etag') != entry.get('etag'))
+            ]
+        if stale:
+            self.forget(stale)
+        return len(stale)
+
+    def _update(self, update):
+        """update(states) で書き換えて条件付きで保存（競合したら読み直してやり直す）。False なら保存しない"""
+        with self._lock:
+            self._ensure_loaded()
+            for _ in range(self.config['max_retries']):
+                if not update(self._states):
+                    return
+                etag = conditional_put(
+                    self.s3_client, self.bucket, self.config['key'],
+                    json.dumps(self._states, ensure_ascii=False).encode('utf-8'),
+                    if_match=self._etag,
+                    if_none_match=None if self._etag else '*',
+                    content_type='application/json'
+                )
+                if etag is not None:
+                    self._etag = etag
+                    return
+                self._load()
+            raise RuntimeError("進捗ファイルの更新が競合し続けたため保存できませんでした")
+
+    def pending_uploads(self, published):
+        """アップロード済みだが履歴に未記録のファイル数（公開枠を使っている）"""
+        with self._lock:
+            self._ensure_loaded()
+            return sum(
+                1 for key, entry in self._states.items()
+                if key not in published and self.reached(entry, 'uploaded')
+            )
+
+    def video_ids(self):
+        with self._lock:
+            self._ensure_loaded()
+            return {entry['video_id'] for entry in self._states.values() if entry.get('video_id')}
+
+
+class AudioCatalog:
+    """
+    音声ファイルのカタログ（R2上のJSON）と、時間予算に収まるファイルの計画
+    キー毎に長さ・サイズ・ETag・タイトルと、実測した変換・アップロード時間を持ち、
+    全体のダウンロード・変換・アップロード速度は実行毎の実測で更新する
+    """
+
+    def __init__(self, s3_client, bucket, config=CATALOG_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self.files = None
+        self.rates = dict(config['default_rates'])
+        self._dirty = False
+
+    def load(self):
+        from botocore.exceptions import ClientError
+
+        if self.files is not None:
+            return
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.config['key'])
+            data = json.loads(response['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] != "NoSuchKey":
+                print(f"  ⚠️ カタログの取得エラー: {e}")
+            data = {}
+        except ValueError:
+            data = {}
+        self.files = data.get('files', {})
+        self.rates.update(data.get('rates', {}))
+
+    def save(self):
+        if not self._dirty:
+            return
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.config['key'],
+            Body=json.dumps({'version': 1, 'files': self.files, 'rates': self.rates}, ensure_ascii=False).encode('utf-8'),
+            ContentType='application/json'
+        )
+        self._dirty = False
+
+    def refresh(self, keys, objects, title_of, probe):
+        """
+        未登録・ETag が変わったキーを調べて登録する
+        probe(key) は長さ（秒）か None を返す。調べられなければサイズから見積もる
+        """
+        self.load()
+        stale = [
+            key for key in keys
+            if self.files.get(key, {}).get('etag') != objects.get(key, {}).get('etag')
+        ]
+        if not stale:
+            return 0
+
+        print(f"  🔎 カタログに登録: {len(stale)}ファイル")
+        with ThreadPoolExecutor(max_workers=self.config['probe_workers']) as pool:
+            durations = list(pool.map(probe, stale))
+
+        for key, duration in zip(stale, durations):
+            meta = objects.get(key, {})
+            entry = {
+                'etag': meta.get('etag'),
+                'size': meta.get('size', 0),
+                'title': title_of(key),
+                'duration': duration,
+            }
+            if duration is None:
+                entry['duration'] = meta.get('size', 0) * 8 / self.config['assumed_bit_rate']
+                entry['estimated'] = True
+            self.files[key] = entry
+        self._dirty = True
+        return len(stale)
+
+    def estimate(self, key):
+        """ステージ毎の見積もり秒数 {'download', 'encode', 'upload'}（固定の付帯時間は upload に含める）"""
+        entry = self.files.get(key, {})
+        rates = self.rates
+        duration = entry.get('duration') or 0
+        observed = entry.get('observed', {})
+        return {
+            'download': entry.get('size', 0) / rates['download_bps'],
+            'encode': observed.get('encode_seconds', duration / rates['encode_speed']),
+            'upload': observed.get(
+                'upload_seconds', duration * rates['video_bytes_per_second'] / rates['upload_bps']
+            ) + self.config['overhead_seconds'],
+        }
+
+    @staticmethod
+    def _list_schedule(durations, workers):
+        """与えた順に、いちばん空いているワーカーへ割り当てたときの所要時間"""
+        loads = [0.0] * max(1, workers)
+        for duration in durations:
+            loads[loads.index(min(loads))] += duration
+        return max(loads)
+
+    def makespan(self, keys, workers=None):
+        """
+        keys をまとめて処理したときの所要時間の見積もり
+        workers=None は逐次処理（合計）。パイプラインではステージ毎に keys の順で詰めた最大値に、
+        1本目がパイプラインを満たすまでの時間を足す
+        """
+        estimates = [self.estimate(key) for key in keys]
+        if not estimates:
+            return 0.0
+        if workers is None:
+            return sum(sum(e.values()) for e in estimates)
+        busiest = max(
+            self._list_schedule([e[stage] for e in estimates], workers.get(stage, 1))
+            for stage in ('download', 'encode', 'upload')
+        )
+        return busiest + max(sum(e.values()) - max(e.values()) for e in estimates)
+
+    def plan(self, keys, budget_seconds, max_files=None, workers=None):
+        """
+        優先順（keys の順）に候補を見て、予算に収まらない最初のファイルの手前までを選ぶ
+        後ろの短いファイルで隙間を埋めることはしない（公開枠は処理順に割り当てるので、飛ばすと公開日がキー順でなくなる）
+        見積もりは makespan() と同じ計算を、1本足す毎に積み上げて求める
+        max_files=0 なら何も選ばない（None は上限なし）
+        """
+        self.load()
+        budget = budget_seconds * self.config['safety']
+        stages = ('download', 'encode', 'upload')
+        loads = {stage: [0.0] * max(1, (workers or {}).get(stage, 1)) for stage in stages}
+        total = fill = estimate = 0.0
+        chosen = []
+        for key in keys:
+            if max_files is not None and len(chosen) >= max_files:
+                break
+            e = self.estimate(key)
+            if workers is None:
+                candidate = total + sum(e.values())
+            else:
+                # 各ステージでいちばん空いているワーカーに足したときの最大 + パイプラインを満たすまでの時間
+                busiest = max(max(max(loads[stage]), min(loads[stage]) + e[stage]) for stage in stages)
+                candidate = busiest + max(fill, sum(e.values()) - max(e.values()))
+            if candidate > budget:
+                break
+            total += sum(e.values())
+            for stage in stages:
+                loads[stage][loads[stage].index(min(loads[stage]))] += e[stage]
+            fill = max(fill, sum(e.values()) - max(e.values()))
+            estimate = candidate
+            chosen.append(key)
+
+        print(f"  ⏱️ 時間予算 {budget_seconds / 60:g}分 → {len(chosen)}ファイル"
+              f" (見積もり {estimate / 60:.1f}分, 次回に回す {len(keys) - len(chosen)}ファイル)")
+        return chosen
+
+    def observe(self, events):
+        """今回の計測イベントから、キー毎の実測時間と全体の速度を更新する"""
+        self.load()
+        per_key = {}
+        totals = {'download_bytes': 0, 'download_seconds': 0.0, 'audio_seconds': 0.0, 'encode_seconds': 0.0,
+                  'upload_bytes': 0, 'upload_seconds': 0.0}
+        prefetched = {e['key'] for e in events if e['stage'] == 'prefetch' and e['status'] == 'ok'}
+        for event in events:
+            if event['status'] != 'ok' or not event.get('seconds'):
+                continue
+            stage, key = event['stage'], event.get('key')
+            if stage == 'prefetch' or (stage == 'download' and key not in prefetched):
+                totals['download_bytes'] += event['bytes']
+                totals['download_seconds'] += event['seconds']
+            elif stage == 'encode' and event.get('audio_seconds'):
+                totals['audio_seconds'] += event['audio_seconds']
+                totals['encode_seconds'] += event['seconds']
+                per_key.setdefault(key, {})['encode_seconds'] = round(event['seconds'], 2)
+                per_key[key]['video_bytes'] = event['bytes']
+            elif stage == 'upload':
+                totals['upload_bytes'] += event['bytes']
+                totals['upload_seconds'] += event['seconds']
+                per_key.setdefault(key, {})['upload_seconds'] = round(event['seconds'], 2)
+
+        observed = {}
+        if totals['download_seconds'] and totals['download_bytes']:
+            observed['download_bps'] = totals['download_bytes'] / totals['download_seconds']
+        if totals['encode_seconds'] and totals['audio_seconds']:
+            observed['encode_speed'] = totals['audio_seconds'] / totals['encode_seconds']
+        if totals['upload_seconds'] and totals['upload_bytes']:
+            observed['upload_bps'] = totals['upload_bytes'] / totals['upload_seconds']
+        video_bytes = sum(v.get('video_bytes', 0) for v in per_key.values())
+        if video_bytes and totals['audio_seconds']:
+            observed['video_bytes_per_second'] = video_bytes / totals['audio_seconds']
+
+        alpha = self.config['smoothing']
+        for name, value in observed.items():
+            self.rates[name] = (1 - alpha) * self.rates[name] + alpha * value
+        for key, values in per_key.items():
+            if key in self.files:
+                self.files[key].setdefault('observed', {}).update(
+                    {k: v for k, v in values.items() if k != 'video_bytes'}
+                )
+        if observed or per_key:
+            self._dirty = True
+
+
+def loudness_gain(measurement, config=LOUDNESS_CONFIG):
+    """測定値から目標ラウドネスまでのゲイン（dB）。トゥルーピークが上限を超えない範囲に抑える"""
+    measured_i, measured_tp = measurement['input_i'], measurement['input_tp']
+    if measured_i == float('-inf'):
+        # 無音
+        return 0.0
+    gain = min(config['target_i'] - measured_i, config['max_gain_db'])
+    if measured_tp != float('-inf'):
+        gain = min(gain, config['target_tp'] - measured_tp)
+    return round(gain, 2)
+
+
+class LoudnessIndex:
+    """
+    ラウドネス測定結果（R2上のJSON）
+    元ファイルの ETag 毎に保存するので、再変換・再試行で音声を2回デコードしない
+    """
+
+    def __init__(self, s3_client, bucket, config=LOUDNESS_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self.files = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        from botocore.exceptions import ClientError
+
+        with self._lock:
+            if self.files is not None:
+                return
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket, Key=self.config['key'])
+                data = json.loads(response['Body'].read().decode('utf-8'))
+            except ClientError as e:
+                if e.response['Error']['Code'] != "NoSuchKey":
+                    print(f"  ⚠️ ラウドネス測定結果の取得エラー: {e}")
+                data = {}
+            except ValueError:
+                data = {}
+            self.files = data.get('files', {})
+
+    def get(self, key, etag):
+        self.load()
+        entry = self.files.get(key)
+        if not entry or entry.get('etag') != etag:
+            return None
+        return entry
+
+    def put(self, key, etag, measurement):
+        """測定結果を登録してすぐ保存（途中で落ちても測り直さない）"""
+        self.load()
+        with self._lock:
+            self.files[key] = dict(measurement, etag=etag)
+            body = json.dumps({'version': 1, 'files': self.files}, ensure_ascii=False).encode('utf-8')
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.config['key'], Body=body, ContentType='application/json'
+        )
+
+
+def normalize_title(title):
+    """重複判定用にタイトルを正規化（全角半角・大文字小文字・空白・記号の違いを無視）"""
+    title = unicodedata.normalize('NFKC', title).lower()
+    return re.sub(r'[\W_]+', '', title)
+
+
+def audio_fingerprint(samples, config=DEDUP_CONFIG):
+    """
+    モノラルPCMから音声の指紋を作る（窓毎に16ビット）
+    各ビットは「隣り合う帯域のエネルギー差」が前の窓より増えたかどうかで、音量の違いや再エンコードに強い
+    """
+    import numpy as np
+
+    frame, hop = config['frame'], config['hop']
+    count = 1 + (len(samples) - frame) // hop
+    if count < 2:
+        return None
+    index = np.arange(frame)[None, :] + hop * np.arange(count)[:, None]
+    spectrum = np.abs(np.fft.rfft(samples[index] * np.hanning(frame), axis=1)) ** 2
+
+    freqs = np.fft.rfftfreq(frame, 1 / config['sample_rate'])
+    edges = np.geomspace(*config['band_range'], config['bands'] + 1)
+    band = np.searchsorted(edges, freqs, side='right') - 1
+    inside = (band >= 0) & (band < config['bands'])
+    energy = np.zeros((count, config['bands']))
+    np.add.at(energy.T, band[inside], spectrum[:, inside].T)
+
+    diff = energy[:, :-1] - energy[:, 1:]
+    bits = (diff[1:] - diff[:-1]) > 0
+    return np.packbits(bits, axis=1).view('>u2').ravel().astype(np.uint16)
+
+
+class FingerprintIndex:
+    """
+    音声の指紋インデックス（R2上のJSON）
+    キー毎に ETag・正規化タイトル・指紋と照合結果を持ち、元ファイルが差し替えられたら取り直す。
+    照合に使った公開済みの指紋は references に追加順で残し、照合結果には何件目まで比べたかを記録する。
+    次回は増えた参照とだけ比べればよい
+    """
+
+    def __init__(self, s3_client, bucket, config=DEDUP_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self.files = None
+        self.references = []    # [[キー, ETag], ...] 参照に加えた順
+        self._dirty = False
+        self._popcount = None
+
+    def load(self):
+        from botocore.exceptions import ClientError
+
+        if self.files is not None:
+            return
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.config['key'])
+            data = json.loads(response['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] != "NoSuchKey":
+                print(f"  ⚠️ 指紋インデックスの取得エラー: {e}")
+            data = {}
+        except ValueError:
+            data = {}
+        self.files = data.get('files', {})
+        self.references = data.get('references', [])
+
+    def save(self):
+        if not self._dirty:
+            return
+        body = {'version': 2, 'files': self.files, 'references': self.references}
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.config['key'],
+            Body=json.dumps(body, ensure_ascii=False).encode('utf-8'),
+            ContentType='application/json'
+        )
+        self._dirty = False
+
+    def get(self, key, etag):
+        """登録済みの指紋（numpy 配列）。未登録・ETag 違いなら None"""
+        import numpy as np
+
+        entry = self.files.get(key)
+        if not entry or entry.get('etag') != etag or not entry.get('fingerprint'):
+            return None
+        return np.frombuffer(base64.b64decode(entry['fingerprint']), dtype='>u2').astype(np.uint16)
+
+    def put(self, key, etag, title, fingerprint):
+        self.files[key] = {
+            'etag': etag,
+            'title': normalize_title(title),
+            'fingerprint': base64.b64encode(fingerprint.astype('>u2').tobytes()).decode('ascii'),
+        }
+        self._dirty = True
+
+    def register_references(self, pairs):
+        """
+        (キー, ETag) を参照に加えて、現在有効な参照の {キー: 追加順} を返す
+        差し替えられた参照は新しい ETag で末尾に加え直す（照合済みの候補とも比べ直す）
+        """
+        known = {tuple(pair) for pair in self.references}
+        for key, etag in pairs:
+            if (key, etag) not in known:
+                self.references.append([key, etag])
+                known.add((key, etag))
+                self._dirty = True
+        current = dict(pairs)
+        return {key: position for position, (key, etag) in enumerate(self.references) if current.get(key) == etag}
+
+    def verdict(self, key, etag):
+        """前回の照合結果 {'checked': 比べた参照の件数, 'match': キー/None, 'error': 誤り率}。無ければ None"""
+        entry = self.files.get(key)
+        if not entry or entry.get('etag') != etag:
+            return None
+        return entry.get('verdict')
+
+    def set_verdict(self, key, checked, match):
+        entry = self.files.get(key)
+        if entry is None:
+            return
+        original, error_rate = match or (None, None)
+        verdict = {'checked': checked, 'match': original, 'error': error_rate}
+        if entry.get('verdict') != verdict:
+            entry['verdict'] = verdict
+            self._dirty = True
+
+    def best_match(self, fingerprint, references):
+        """
+        references {キー: 指紋} のうち最も近いもの (キー, ビット誤り率)。しきい値を超えれば None
+        先頭のずれを吸収するため、ずらし幅毎に全候補をまとめて比べる
+        """
+        import numpy as np
+
+        if not references:
+            return None
+        if self._popcount is None:
+            values = np.arange(1 << 16, dtype='>u2').view(np.uint8)
+            self._popcount = np.unpackbits(values).reshape(-1, 16).sum(axis=1).astype(np.uint16)
+
+        seconds_per_frame = self.config['hop'] / self.config['sample_rate']
+        max_shift = int(self.config['max_shift_seconds'] / seconds_per_frame)
+        min_overlap = int(self.config['min_overlap_seconds'] / seconds_per_frame)
+
+        keys = list(references)
+        lengths = np.array([len(references[key]) for key in keys])
+        width = max(lengths.max(), len(fingerprint))
+        matrix = np.zeros((len(keys), width), dtype=np.uint16)
+        for row, key in enumerate(keys):
+            matrix[row, :lengths[row]] = references[key]
+        columns = np.arange(width)
+
+        best = np.ones(len(keys))
+        for shift in range(-max_shift, max_shift + 1):
+            # shift > 0: 候補の先頭 shift 窓を飛ばす / shift < 0: 参照側を飛ばす
+            own, other = max(shift, 0), max(-shift, 0)
+            span = min(len(fingerprint) - own, width - other)
+            if span < min_overlap:
+                continue
+            valid = columns[None, :span] < (lengths - other)[:, None]
+            xor = matrix[:, other:other + span] ^ fingerprint[None, own:own + span]
+            errors = (self._popcount[xor] * valid).sum(axis=1)
+            overlap = valid.sum(axis=1)
+            rate = np.where(overlap >= min_overlap, errors / (16 * np.maximum(overlap, 1)), 1.0)
+            best = np.minimum(best, rate)
+
+        row = int(best.argmin())
+        if best[row] > self.config['max_bit_error']:
+            return None
+        return keys[row], float(best[row])
+
+
+class ThumbnailRenderer:
+    """
+    サムネイル描画エンジン
+    テンプレート画像は最初の1回だけデコードし、フォントはサイズ毎にLRUキャッシュする。
+    文字幅に収まる最大のフォントサイズを二分探索で求め、縁取りは Pillow の stroke で1回で描く
+    """
+
+    def __init__(self, config=THUMBNAIL_CONFIG):
+        self.config = config
+        self._template = None
+        # FreeType のフォントオブジェクトはスレッド間で同時に使えないので描画を直列化する
+        self._lock = threading.Lock()
+        self._font = functools.lru_cache(maxsize=len(config['font_sizes']))(self._load_font)
+
+    def _load_font(self, size):
+        from PIL import ImageFont
+        try:
+            return ImageFont.truetype(self.config['font_path'], size)
+        except OSError:
+            return None
+
+    def template(self):
+        if self._template is None:
+            from PIL import Image
+            self._template = Image.open(self.config['template_image']).convert('RGB')
+        return self._template
+
+    @staticmethod
+    def _text_size(draw, title, font):
+        bbox = draw.textbbox((0, 0), title, font=font)
+        return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+    def fit_font(self, draw, title):
+        """最大幅に収まる最大サイズのフォントを返す (font, size, width, height)"""
+        sizes = self.config['font_sizes']
+        if self._font(sizes[0]) is None:
+            # フォントが無い環境ではデフォルトフォントで縮小なし
+            from PIL import ImageFont
+            font = ImageFont.load_default()
+            return (font, sizes[0]) + self._text_size(draw, title, font)
+
+        # sizes は大きい順なので、収まる最初の位置を二分探索（文字幅はサイズに対して単調増加）
+        low, high = 0, len(sizes) - 1
+        while low < high:
+            mid = (low + high) // 2
+            width, _ = self._text_size(draw, title, self._font(sizes[mid]))
+            if width <= self.config['max_text_width']:
+                high = mid
+            else:
+                low = mid + 1
+
+        size = sizes[low]
+        font = self._font(size)
+        return (font, size) + self._text_size(draw, title, font)
+
+    @staticmethod
+    def band_center_y(font_size):
+        """フォントサイズに応じた帯の中心Y座標"""
+        if font_size >= 85:
+            return 438
+        elif font_size >= 75:
+            return 443
+        elif font_size >= 65:
+            return 448
+        elif font_size >= 55:
+            return 452
+        return 455
+
+    def draw(self, title):
+        """テンプレートにタイトルを描いた画像と、使用したフォントサイズを返す"""
+        from PIL import ImageDraw
+        with self._lock:
+            img = self.template().copy()
+            draw = ImageDraw.Draw(img)
+            font, font_size, text_width, text_height = self.fit_font(draw, title)
+
+            x = self.config['band_center_x'] - text_width / 2
+            y = self.band_center_y(font_size) - text_height / 2
+            draw.text(
+                (x, y), title, font=font,
+                fill=self.config['text_color'],
+                stroke_width=self.config['outline_width'],
+                stroke_fill=self.config['outline_color']
+            )
+        return img, font_size
+
+    def render(self, title, output_path):
+        """1枚描画して保存。使用したフォントサイズを返す"""
+        img, font_size = self.draw(title)
+        img.save(output_path, quality=95)
+        return font_size
+
+    def render_jpeg(self, title, output_path, max_bytes, qualities):
+        """
+        最適化JPEGで保存（品質を下げながら max_bytes 以下に収める）
+        (フォントサイズ, バイト数, 品質) を返す
+        """
+        import io
+        img, font_size = self.draw(title)
+        for quality in qualities:
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+            if buffer.tell() <= max_bytes:
+                break
+        with open(output_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        return font_size, buffer.tell(), quality
+
+    def render_batch(self, items):
+        """[(タイトル, 出力パス)] をまとめて描画。各フォントサイズのリストを返す"""
+        return [self.render(title, output_path) for title, output_path in items]
+
+
+# 事前生成用のワーカープロセス毎の描画エンジン（テンプレート・フォントをプロセス内で使い回す）
+_prerender_renderer = None
+
+
+def _init_prerender_worker(config):
+    global _prerender_renderer
+    _prerender_renderer = ThumbnailRenderer(config)
+
+
+def _prerender_worker(item):
+    """(元ファイル, タイトル, 出力パス) → (元ファイル, 出力パス, バイト数, 品質)"""
+    audio_key, title, output_path = item
+    _, size, quality = _prerender_renderer.render_jpeg(
+        title, output_path, PRERENDER_CONFIG['max_bytes'], PRERENDER_CONFIG['jpeg_qualities']
+    )
+    return audio_key, output_path, size, quality
+
+
+class ThumbnailPrerenderer:
+    """
+    未公開ファイルのサムネイルをプロセスプールでまとめて描画し、R2に置く
+    マニフェスト（元ファイル → キャッシュキー・R2キー）で、日次実行は描画せず小さなJPEGを取ってくるだけにする
+    """
+
+    def __init__(self, s3_client, bucket, config=PRERENDER_CONFIG):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.config = config
+        self._lock = threading.Lock()
+        self.manifest = None
+
+    def load_manifest(self):
+        from botocore.exceptions import ClientError
+
+        with self._lock:
+            if self.manifest is None:
+                try:
+                    response = self.s3_client.get_object(Bucket=self.bucket, Key=self.config['manifest_key'])
+                    self.manifest = json.loads(response['Body'].read().decode('utf-8'))
+                except ClientError as e:
+                    if e.response['Error']['Code'] != "NoSuchKey":
+                        print(f"  ⚠️ サムネイルマニフェストの取得エラー: {e}")
+                    self.manifest = {}
+                except ValueError:
+                    self.manifest = {}
+            return self.manifest
+
+    def save_manifest(self):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.config['manifest_key'],
+            Body=json.dumps(self.manifest, ensure_ascii=False).encode('utf-8'),
+            ContentType='application/json'
+        )
+
+    def fetch(self, audio_key, cache_key, output_path):
+        """事前生成済みで設定も一致すれば output_path に取ってきて True"""
+        from botocore.exceptions import ClientError
+
+        entry = self.load_manifest().get(audio_key)
+        if not entry or entry.get('cache_key') != cache_key:
+            return False
+        try:
+            self.s3_client.download_file(self.bucket, entry['object'], output_path)
+        except ClientError as e:
+            print(f"  ⚠️ 事前生成サムネイルの取得エラー: {e}")
+            return False
+        return True
+
+    def run(self, items, workdir):
+        """
+        items: [(元ファイル, タイトル, キャッシュキー)]
+        生成済み（キャッシュキー一致）のものは飛ばし、残りを並列に描画してアップロードする
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        manifest = self.load_manifest()
+        todo = [item for item in items if manifest.get(item[0], {}).get('cache_key') != item[2]]
+        print(f"🖼️ サムネイル事前生成: {len(todo)}枚（生成済み {len(items) - len(todo)}枚）")
+        if not todo:
+            return 0
+
+        cache_keys = {audio_key: cache_key for audio_key, _, cache_key in todo}
+        jobs = [
+            (audio_key, title, os.path.join(workdir, f"{cache_key}.jpg"))
+            for audio_key, title, cache_key in todo
+        ]
+        total_bytes = 0
+        with ProcessPoolExecutor(
+            max_workers=self.config['workers'],
+            initializer=_init_prerender_worker,
+            initargs=(THUMBNAIL_CONFIG,)
+        ) as pool:
+            for done, (audio_key, path, size, quality) in enumerate(pool.map(_prerender_worker, jobs, chunksize=4), 1):
+                cache_key = cache_keys[audio_key]
+                object_key = f"{self.config['r2_prefix']}{cache_key}.jpg"
+                self.s3_client.upload_file(path, self.bucket, object_key, ExtraArgs={'ContentType': 'image/jpeg'})
+                os.remove(path)
+                manifest[audio_key] = {'cache_key': cache_key, 'object': object_key, 'bytes': size, 'quality': quality}
+                total_bytes += size
+                print(f"  ✓ [{done}/{len(jobs)}] {audio_key} ({size // 1024}KB, q={quality})")
+
+        self.save_manifest()
+        print(f"  ✓ 事前生成完了: {len(jobs)}枚 / 平均 {total_bytes // len(jobs) // 1024}KB")
+        return len(jobs)
+
+
+class TranscodePool:
+    """
+    ffmpeg プロセスの同時実行数とスレッド数を管理するプール
+    ジョブ数 × スレッド数が total_threads を超えないように -threads を付けて起動し、
+    stderr の進捗を逐次読みながらスループット（音声分/実時間秒）を集計する
+    """
+
+    _DURATION_RE = re.compile(rb'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+    _TIME_RE = re.compile(rb'time=(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+    def __init__(self, max_jobs=None, total_threads=None, config=ENCODE_CONFIG):
+        self.config = config
+        self.max_jobs = max(1, max_jobs or config['max_jobs'])
+        self.total_threads = total_threads or config['total_threads']
+        self.threads_per_job = max(1, self.total_threads // self.max_jobs)
+        self._slots = threading.Semaphore(self.max_jobs)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._busy_since = None
+        self.busy_seconds = 0.0
+        self.audio_seconds = 0.0
+        self.jobs_done = 0
+
+    @staticmethod
+    def _seconds(match):
+        hours, minutes, seconds = match.groups()
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    def _with_threads(self, cmd):
+        """出力ファイル名の直前に -threads を差し込む"""
+        return cmd[:-1] + ['-threads', str(self.threads_per_job)] + cmd[-1:]
+
+    def _enter(self):
+        with self._lock:
+            if self._active == 0:
+                self._busy_since = time.monotonic()
+            self._active += 1
+
+    def _leave(self, audio_seconds):
+        with self._lock:
+            self._active -= 1
+            if self._active == 0:
+                self.busy_seconds += time.monotonic() - self._busy_since
+            self.audio_seconds += audio_seconds
+            self.jobs_done += 1
+
+    def run(self, cmd, label='', stdin_feed=None, stdout_sink=None):
+        """
+        ffmpeg を1本実行（空きが出るまで待つ）。変換した音声の秒数を返す
+        stdin_feed を渡すと、別スレッドで stdin_feed(proc.stdin) を呼んで入力を流し込む
+        stdout_sink を渡すと、別スレッドで stdout_sink(proc.stdout) を呼んで出力を読ませる
+        """
+        with self._slots:
+            self._enter()
+            encoded = 0.0
+            try:
+                encoded = self._run(self._with_threads(cmd), label, stdin_feed, stdout_sink)
+            finally:
+                self._leave(encoded)
+        return encoded
+
+    @staticmethod
+    def _feed(proc, stdin_feed, errors):
+        try:
+            stdin_feed(proc.stdin)
+        except BrokenPipeError:
+            # ffmpeg が先に終了した（終了コードで判定する）
+            pass
+        except Exception as e:
+            errors.append(e)
+            proc.kill()
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def _run(self, cmd, label, stdin_feed=None, stdout_sink=None):
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if stdin_feed else subprocess.DEVNULL,
+            stdout=subprocess.PIPE if stdout_sink else subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        feed_errors = []
+        feeder = None
+        if stdin_feed:
+            feeder = threading.Thread(target=self._feed, args=(proc, stdin_feed, feed_errors), daemon=True)
+            feeder.start()
+        reader = None
+        if stdout_sink:
+            reader = threading.Thread(target=stdout_sink, args=(proc.stdout,), daemon=True)
+            reader.start()
+
+        tail = deque(maxlen=40)
+        duration = 0.0
+        encoded = 0.0
+        next_report = self.config['progress_step']
+        buffer = b''
+
+        # ffmpeg は進捗行を \r で上書きするので \r と \n の両方で区切って読む
+        while True:
+            chunk = proc.stderr.read1(4096)
+            if not chunk:
+                break
+            buffer += chunk
+            lines = re.split(rb'[\r\n]', buffer)
+            buffer = lines.pop()
+            for line in lines:
+                if not line.strip():
+                    continue
+                tail.append(line)
+                match = self._DURATION_RE.search(line)
+                if match:
+                    duration = max(duration, self._seconds(match))
+                    continue
+                match = self._TIME_RE.search(line)
+                if match:
+                    encoded = self._seconds(match)
+                    if duration and encoded * 100 / duration >= next_report:
+                        print(f"  ... {label} {int(encoded * 100 / duration)}%")
+                        next_report += self.config['progress_step']
+
+        returncode = proc.wait()
+        if feeder:
+            feeder.join()
+        if reader:
+            reader.join()
+        if feed_errors:
+            # 入力が途中で途切れた場合、ffmpeg は正常終了しても動画が欠けているので失敗扱い
+            raise RuntimeError(f"ffmpeg への入力ストリームが中断しました: {feed_errors[0]}")
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, stderr=b'\n'.join(tail))
+        return encoded or duration
+
+    def throughput(self):
+        """音声分 / 実時間秒（いずれかのジョブが動いていた時間で割る）"""
+        if not self.busy_seconds:
+            return 0.0
+        return (self.audio_seconds / 60) / self.busy_seconds
+
+    def report(self):
+        if not self.jobs_done:
+            return
+        print(f"📊 動画変換: {self.jobs_done}本 / 音声{self.audio_seconds / 60:.1f}分 / "
+              f"{self.busy_seconds:.1f}秒 ({self.throughput():.2f} 音声分/秒, "
+              f"{self.max_jobs}並列 × {self.threads_per_job}スレッド)")
+
+
+class StagedPipeline:
+    """
+    ステージ間を有界キューでつないだスレッドパイプライン
+    stages: [(ステージ名, 関数, ワーカー数, 順序保証するか)]
+    ジョブは {'index': n, 'error': None, ...} の dict。
+    失敗したジョブも後段へ流し（関数は実行しない）、順序保証ステージが番号を待ち続けないようにする。
+    """
+
+    _STOP = object()
+
+    def __init__(self, stages, queue_size=2, on_finish=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_finish = on_finish
+
+    def _run_job(self, name, func, job):
+        if job['error'] is not None:
+            return
+        try:
+            func(job)
+        except (QuotaExceededError, ShutdownRequested) as e:
+            print(f"  ⏭️ [{job['index'] + 1}] {name}を中止: {e}")
+            job['error'] = e
+        except Exception as e:
+            print(f"  ❌ [{job['index'] + 1}] {name}エラー: {e}")
+            traceback.print_exc()
+            job['error'] = e
+            # ステージ内で原因の段階を決めていればそちらを残す（変換しながらのアップロードなど）
+            job['failed_stage'] = job.get('failed_stage') or name
+
+    def _worker(self, name, func, q_in, q_out, remaining, lock):
+        while True:
+            job = q_in.get()
+            if job is self._STOP:
+                # 同じステージの他ワーカーにも停止を伝える
+                q_in.put(self._STOP)
+                break
+            self._run_job(name, func, job)
+            if q_out is not None:
+                q_out.put(job)
+            elif self.on_finish:
+                self.on_finish(job)
+
+        # ステージ最後のワーカーが次段に停止を伝える
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and q_out is not None:
+            q_out.put(self._STOP)
+
+    def _reorder(self, q_in, q_out):
+        """ジョブを index 順に並べ直して次段へ流す"""
+        pending = {}
+        next_index = 0
+        while True:
+            job = q_in.get()
+            if job is self._STOP:
+                break
+            pending[job['index']] = job
+            while next_index in pending:
+                q_out.put(pending.pop(next_index))
+                next_index += 1
+        for index in sorted(pending):
+            q_out.put(pending[index])
+        q_out.put(self._STOP)
+
+    def run(self, jobs):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+
+        for i, (name, func, workers, ordered) in enumerate(self.stages):
+            q_in = queues[i]
+            if ordered:
+                ordered_q = queue.Queue(maxsize=self.queue_size)
+                threads.append(threading.Thread(target=self._reorder, args=(q_in, ordered_q), daemon=True))
+                q_in = ordered_q
+            q_out = queues[i + 1] if i + 1 < len(self.stages) else None
+            remaining = [max(1, workers)]
+            lock = threading.Lock()
+            for _ in range(remaining[0]):
+                threads.append(threading.Thread(
+                    target=self._worker,
+                    args=(name, func, q_in, q_out, remaining, lock),
+                    name=f"{name}-worker",
+                    daemon=True
+                ))
+
+        for thread in threads:
+            thread.start()
+
+        # 先頭キューが埋まっている間はここで待つ（先読みしすぎない）
+        for job in jobs:
+            queues[0].put(job)
+        queues[0].put(self._STOP)
+
+        for thread in threads:
+            thread.join()
+
 
 class YouTubeUploader:
-    def __init__(self):
+    def __init__(self, metrics=None):
         """初期化"""
-        # 進捗管理ファイル名（R2上のファイル名）
-        self.remote_progress_file = 'youtube_published.txt'
-        
+        self.metrics = metrics or RunMetrics()
         self.s3_client = self._init_r2_client()
+        # 進捗管理（R2上の公開履歴）
+        self.history = PublishedHistory(self.s3_client, R2_CONFIG['bucket_name'])
+        self.lister = R2Lister(self.s3_client, R2_CONFIG['bucket_name'])
+        self.r2_objects = {}
+        self.transcoder = TranscodePool()
+        self.encode_profile = ENCODE_CONFIG['profile']
+        self.stream_input = False
+        self.stream_output = False
+        self.thumbnail_renderer = ThumbnailRenderer()
+        self.cache = ArtifactCache(self.s3_client, R2_CONFIG['bucket_name'])
+        self.prerendered = ThumbnailPrerenderer(self.s3_client, R2_CONFIG['bucket_name'])
+        # バッチ中の音声先読み（process_batch の間だけ動かす）
+        self.prefetcher = None
+        self._thumbnail_settings_cache = None
+        self.upload_sessions = UploadSessionStore(self.s3_client, R2_CONFIG['bucket_name'])
+        self.file_states = FileStateStore(self.s3_client, R2_CONFIG['bucket_name'])
+        self.catalog = AudioCatalog(self.s3_client, R2_CONFIG['bucket_name'])
+        self.fingerprints = FingerprintIndex(self.s3_client, R2_CONFIG['bucket_name'])
+        self.loudness = LoudnessIndex(self.s3_client, R2_CONFIG['bucket_name'])
+        self.quota = QuotaLedger(self.s3_client, R2_CONFIG['bucket_name'])
+        # クォータ切れを受けたら立てる。以降のジョブはダウンロード前に中止する
+        self.quota_stop = threading.Event()
+        # 停止要求（常駐モードのシグナルハンドラが立てる）
+        self.shutdown = threading.Event()
+        # 複数ノードで同じバケットを処理するときの排他（--coordinate）
+        self.leases = None
+        # チャンネル上の動画と履歴を突き合わせる（--reconcile）
+        self.verify_channel = False
+        self.credentials = None
         self.youtube = None
+        # httplib2 の既定クライアントはスレッドセーフではない（PooledHttp で作ったときだけ True）
+        self.thread_safe_client = False
         self.published_list = self._load_published()
 
+        # 公開枠の予約（アップロード中の本数を数えて枠の重複を防ぐ）
+        self._slot_lock = threading.Lock()
+        self._uploads_in_flight = 0
+
     def _init_r2_client(self):
         """R2クライアント初期化"""
-        return boto3.client(
+        import boto3
+        from botocore.config import Config
+        client = boto3.client(
             's3',
             endpoint_url=R2_CONFIG['endpoint_url'],
             aws_access_key_id=R2_CONFIG['access_key_id'],
             aws_secret_access_key=R2_CONFIG['secret_access_key'],
-            region_name='auto'
+            region_name='auto',
+            config=Config(
+                max_pool_connections=DOWNLOAD_CONFIG['max_pool_connections'],
+                retries={'mode': DOWNLOAD_CONFIG['retry_mode'], 'max_attempts': DOWNLOAD_CONFIG['max_attempts']},
+                connect_timeout=DOWNLOAD_CONFIG['connect_timeout'],
+                read_timeout=DOWNLOAD_CONFIG['read_timeout'],
+            )
         )
+        # 条件付きPUT（conditional_put）用
+        client.meta.events.register('before-call.s3.PutObject', _inject_conditional_headers)
+        return client
 
     def _load_published(self):
         """R2からアップロード済みリスト読み込み"""
+        from botocore.exceptions import ClientError
+
         print("📂 アップロード済みリストをクラウドから取得中...")
         try:
-            # R2からオブジェクトを取得
-            response = self.s3_client.get_object(
-                Bucket=R2_CONFIG['bucket_name'],
-                Key=self.remote_progress_file
-            )
-            # 中身を読み込んでセットにする
-            content = response['Body'].read().decode('utf-8')
-            published = set(line.strip() for line in content.splitlines() if line.strip())
-            print(f"  ✓ 履歴取得完了: {len(published)}件")
-            return published
-
+            published = self.history.load()
         except ClientError as e:
-            # ファイルがまだない場合（初回など）は404エラーになるので無視して空セットを返す
-            if e.response['Error']['Code'] == "NoSuchKey":
-                print("  ℹ️ 履歴ファイルがありません。新規作成します。")
-                return set()
-            else:
-                # その他のエラーは表示
-                print(f"  ❌ 履歴取得エラー: {e}")
-                raise e
-
-    def _save_published(self, filename):
-        """アップロード済みリストを更新してR2に保存"""
-        # メモリ上のリストに追加
-        self.published_list.add(filename)
-        
-        try:
-            # リストを改行区切りの文字列に変換
-            content = "\n".join(sorted(list(self.published_list)))
-            
-            # R2にアップロード（上書き保存）
-            self.s3_client.put_object(
-                Bucket=R2_CONFIG['bucket_name'],
-                Key=self.remote_progress_file,
-                Body=content.encode('utf-8'),
-                ContentType='text/plain'
-            )
-            print(f"  💾 クラウド上の履歴を更新しました")
-            
-        except Exception as e:
-            print(f"  ❌ 履歴保存エラー: {e}")
-            # クリティカルではないが、次回重複する可能性があるので警告
-
-
-
+            print(f"  ❌ 履歴取得エラー: {e}")
+            raise e
 
+        if self.history.snapshot_etag is None and not published:
+            print("  ℹ️ 履歴ファイルがありません。新規作成します。")
+        else:
+            print(f"  ✓ 履歴取得完了: {len(published)}件 (ジャーナル {len(self.history.journal_lines)}件)")
+        return published
 
+    def _save_published(self, filename, video_id=None, publish_at=None, etag=None):
+        """アップロード済みとして履歴ジャーナルに追記。保存できたら True"""
+        try:
+            self.history.record(filename, video_id=video_id, publish_at=publish_at, etag=etag)
+            print(f"  💾 クラウド上の履歴を更新しました")
+            return True
 
+        except Exception as e:
+            # メモリ上では公開済みにしておき、今回の実行で二重に処理しないようにする
+            self.published_list.add(filename)
+            print(f"  ❌ 履歴保存エラー: {e}")
+            # クリティカルではないが、次回重複する可能性があるので警告
+            return False
 
+    def _refresh_credentials_if_needed(self, token_file=None):
+        """有効期限切れ、または期限が近いときだけトークンをリフレッシュ（それ以外は通信しない）"""
+        token_file = token_file or YOUTUBE_CONFIG['token_file']
+        if not self.credentials or not self.credentials.refresh_token:
+            return
 
+        margin = timedelta(minutes=YOUTUBE_CONFIG['refresh_margin_minutes'])
+        # google-auth の expiry はタイムゾーン無しのUTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        expiry = self.credentials.expiry
+        if self.credentials.valid and (expiry is None or expiry - now > margin):
+            return
 
+        from google.auth.transport.requests import Request
+        print("🔄 トークンをリフレッシュします...")
+        try:
+            self.credentials.refresh(Request())
+            # リフレッシュ成功したら json で保存し直す
+            with open(token_file, "w") as token:
+                token.write(self.credentials.to_json())
+            print("✓ 新しいトークンを token.json に保存しました")
+        except Exception as e:
+            print(f"❌ リフレッシュ失敗: {e}")
+            self.credentials = None
 
     def authenticate_youtube(self):
         """YouTube API認証 (JSON対応版)"""
-        import json
         from google.oauth2.credentials import Credentials
-        from google.auth.transport.requests import Request
-        from google_auth_oauthlib.flow import InstalledAppFlow
 
         self.credentials = None
         # GitHub Actionsに合わせて json を優先
-        token_file = "token.json"
+        token_file = YOUTUBE_CONFIG['token_file']
+        is_github_actions = os.environ.get('GITHUB_ACTIONS') == 'true'
+        scopes = list(YOUTUBE_CONFIG['scopes'])
+        if self.verify_channel:
+            scopes += YOUTUBE_CONFIG['reconcile_scopes']
 
         # 1. token.json (最新の形式) を探す
         if os.path.exists(token_file):
             try:
-                self.credentials = Credentials.from_authorized_user_file(token_file, YOUTUBE_CONFIG['scopes'])
+                with open(token_file) as token:
+                    granted = json.load(token).get('scopes') or YOUTUBE_CONFIG['scopes']
+                missing = [scope for scope in scopes if scope not in granted]
+                # 許可されていないスコープを付けてリフレッシュすると失敗するので、許可済みの範囲で読み込む
+                self.credentials = Credentials.from_authorized_user_file(token_file, granted)
                 print("✓ token.json を読み込みました")
+                if missing:
+                    print(f"⚠️ token.json に {', '.join(missing)} の許可がありません（--reconcile に必要）")
+                    if is_github_actions:
+                        print("   ローカルで --reconcile を付けて再認証し、Secrets の GOOGLE_TOKEN_JSON を更新してください")
+                    else:
+                        print("   追加のスコープで再認証します")
+                        self.credentials = None
             except ValueError:
                 print("❌ token.json の形式が不正です")
 
@@ -183,25 +2988,13 @@ class YouTubeUploader:
             with open("token.pickle", "rb") as token:
                 self.credentials = pickle.load(token)
 
-        # 3. トークンの有効期限切れチェック & リフレッシュ
-        if not self.credentials or not self.credentials.valid:
-            if self.credentials and self.credentials.expired and self.credentials.refresh_token:
-                print("🔄 トークンをリフレッシュします...")
-                try:
-                    self.credentials.refresh(Request())
-                    # リフレッシュ成功したら json で保存し直す
-                    with open(token_file, "w") as token:
-                        token.write(self.credentials.to_json())
-                    print("✓ 新しいトークンを token.json に保存しました")
-                except Exception as e:
-                    print(f"❌ リフレッシュ失敗: {e}")
-                    self.credentials = None
+        # 3. トークンの有効期限チェック & 必要なときだけリフレッシュ
+        self._refresh_credentials_if_needed(token_file)
+        if self.credentials and not self.credentials.valid and not self.credentials.refresh_token:
+            self.credentials = None
 
         # 4. それでも認証できない場合
         if not self.credentials:
-            # GitHub Actions環境かどうかを判定
-            is_github_actions = os.environ.get('GITHUB_ACTIONS') == 'true'
-            
             if is_github_actions:
                 # クラウド上ではブラウザを開けないので、ここで終了させる
                 print("❌ GitHub Actions環境で有効なトークンが見つかりません。")
@@ -209,10 +3002,11 @@ class YouTubeUploader:
                 sys.exit(1)
             
             # ローカル環境ならブラウザ認証を開始
+            from google_auth_oauthlib.flow import InstalledAppFlow
             print("🔐 新規認証を開始します（ブラウザが起動します）...")
             flow = InstalledAppFlow.from_client_secrets_file(
                 YOUTUBE_CONFIG["client_secrets_file"],
-                YOUTUBE_CONFIG["scopes"]
+                scopes
             )
             # localhostで受け取る（新しい方式）
             self.credentials = flow.run_local_server(port=0)
@@ -222,11 +3016,36 @@ class YouTubeUploader:
                 token.write(self.credentials.to_json())
             print("✓ 認証情報を token.json に保存しました")
 
-        self.youtube = googleapiclient.discovery.build(
-            "youtube", "v3", credentials=self.credentials
-        )
+        # APIクライアントは最初に使うときに作る（--test では作らない）
+        self.youtube = None
         print("✅ YouTube認証完了")
 
+    def _build_youtube_client(self):
+        """
+        YouTube APIクライアント生成
+        ライブラリ同梱の静的ディスカバリ文書を使い、ネットワークからの取得とファイルキャッシュを行わない。
+        通信はスレッドセーフなコネクションプール（PooledHttp）を全API呼び出しで共有する
+        """
+        import googleapiclient.discovery
+        client = googleapiclient.discovery.build(
+            "youtube", "v3",
+            http=PooledHttp(self.credentials),
+            static_discovery=True,
+            cache_discovery=False
+        )
+        self.thread_safe_client = True
+        return client
+
+    @property
+    def youtube(self):
+        if self._youtube is None and self.credentials is not None:
+            self._youtube = self._build_youtube_client()
+        return self._youtube
+
+    @youtube.setter
+    def youtube(self, client):
+        self._youtube = client
+
 
 
 
@@ -238,30 +3057,254 @@ class YouTubeUploader:
     def get_audio_files_from_r2(self):
         """R2から未処理の音声ファイル一覧取得"""
         print("📂 R2からファイル一覧取得中...")
-        response = self.s3_client.list_objects_v2(Bucket=R2_CONFIG['bucket_name'])
+        with self.metrics.stage('list') as event:
+            self.r2_objects = self.lister.scan()
+            event['objects'] = len(self.r2_objects)
         audio_files = []
 
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                key = obj['Key']
-                # 音声ファイルかつ、履歴ファイル自体ではないものを対象にする
-                if key.lower().endswith(('.m4a', '.mp3')):
-                    
-                    # ★ここで除外チェックを行う
-                    if key in IGNORE_FILES:
-                        print(f"  ℹ️ 除外リスト設定によりスキップ: {key}")
-                        continue
-                    
-                    if key not in self.published_list:
-                        audio_files.append(key)
+        for key in self.r2_objects:
+            # 音声ファイルかつ、履歴ファイル自体ではないものを対象にする
+            if key.lower().endswith(('.m4a', '.mp3')):
+
+                if key in self.published_list:
+                    continue
+
+                # ★繰り返し失敗しているファイル（IGNORE_FILES を含む）は隔離・待機中なら飛ばす
+                status, failure = self.history.failure_status(key, self.r2_objects[key].get('etag'))
+                if status == 'quarantined':
+                    print(f"  ℹ️ 隔離中のためスキップ: {key} ({failure['last_error']})")
+                    continue
+                if status == 'backoff':
+                    print(f"  ℹ️ 失敗{failure['count']}回のため再試行待ち: {key}")
+                    continue
+
+                audio_files.append(key)
 
         return sorted(audio_files)
 
+    def fingerprint_remote(self, key):
+        """R2上の音声の先頭から指紋を取る（署名付きURLを ffmpeg に渡すので、必要な部分しか読まない）"""
+        import numpy as np
+
+        url = self.s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': R2_CONFIG['bucket_name'], 'Key': key},
+            ExpiresIn=STREAM_CONFIG['url_expires']
+        )
+        cmd = [
+            'ffmpeg', '-v', 'error', '-i', url, '-t', str(DEDUP_CONFIG['seconds']),
+            '-vn', '-ac', '1', '-ar', str(DEDUP_CONFIG['sample_rate']), '-f', 's16le', 'pipe:1'
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, check=True, timeout=300)
+        except (subprocess.SubprocessError, OSError) as e:
+            print(f"  ⚠️ 指紋を取れませんでした: {key} ({e})")
+            return None
+        samples = np.frombuffer(result.stdout, dtype='<i2').astype(np.float32)
+        return audio_fingerprint(samples)
+
+    def skip_duplicates(self, audio_files, batch=None):
+        """
+        公開済みと同じ録音を処理対象から外す（DEDUP_CONFIG['action'] が 'flag' なら警告だけ）
+        正規化タイトルが公開済みと一致するファイルは、両方の指紋を取って照合する。
+        それ以外も先頭 max_new_per_run 件は指紋を取り、公開済みの指紋と照合する。
+        照合結果は指紋インデックスに残し、次回は前回より後に増えた公開済みの指紋とだけ比べる。
+        公開済みで指紋の無いファイルは、実行毎に backfill_per_run 件ずつ登録していく。
+        batch（{キー: 指紋}）には今回処理するファイルを足していき、同じ回の中の重複も外す
+        """
+        self.fingerprints.load()
+        batch = {} if batch is None else batch
+        etag_of = lambda key: self.r2_objects.get(key, {}).get('etag')
+        title_of = lambda key: normalize_title(self.extract_title_from_filename(key))
+
+        published_by_title = {}
+        for key in self.published_list:
+            if key in self.r2_objects:
+                published_by_title.setdefault(title_of(key), []).append(key)
+
+        title_matches = {}
+        needed = []
+        for position, key in enumerate(audio_files):
+            title_matches[key] = published_by_title.get(title_of(key), [])
+            if title_matches[key] or position < DEDUP_CONFIG['max_new_per_run']:
+                needed.append(key)
+                needed.extend(title_matches[key])
+        needed = [key for key in dict.fromkeys(needed) if self.fingerprints.get(key, etag_of(key)) is None]
+
+        # タイトルが違う再アップロードも見つけられるよう、公開済みの指紋を少しずつ揃える
+        backfill = [
+            key for key in self.published_list
+            if key in self.r2_objects and key not in needed and self.fingerprints.get(key, etag_of(key)) is None
+        ][:DEDUP_CONFIG['backfill_per_run']]
+        if backfill:
+            print(f"  🔎 公開済みの指紋を追加登録: {len(backfill)}ファイル")
+            needed.extend(backfill)
+
+        if needed:
+            print(f"  🔎 音声の指紋を計算: {len(needed)}ファイル")
+            with ThreadPoolExecutor(max_workers=DEDUP_CONFIG['workers']) as pool:
+                for key, fingerprint in zip(needed, pool.map(self.fingerprint_remote, needed)):
+                    if fingerprint is not None:
+                        self.fingerprints.put(key, etag_of(key), self.extract_title_from_filename(key), fingerprint)
+
+        # 公開済みの指紋（参照）と、その追加順
+        positions = self.fingerprints.register_references([
+            (key, etag_of(key)) for key in self.published_list
+            if key in self.r2_objects and self.fingerprints.get(key, etag_of(key)) is not None
+        ])
+        checked = len(self.fingerprints.references)
+        decoded = {}
+
+        def references_from(start):
+            for key, position in positions.items():
+                if position >= start and key not in decoded:
+                    decoded[key] = self.fingerprints.get(key, etag_of(key))
+            return {key: decoded[key] for key, position in positions.items() if position >= start}
+
+        result = []
+        for key in audio_files:
+            fingerprint = self.fingerprints.get(key, etag_of(key))
+            match = None
+            if fingerprint is not None:
+                verdict = self.fingerprints.verdict(key, etag_of(key))
+                if verdict and (verdict['match'] is None or verdict['match'] in positions):
+                    # 前回の結果に、その後に増えた参照との照合だけを足す
+                    start = verdict['checked']
+                    if verdict['match']:
+                        match = (verdict['match'], verdict['error'])
+                else:
+                    start = 0
+                new_references = references_from(start) if start < checked else {}
+                found = self.fingerprints.best_match(fingerprint, new_references)
+                if found and (match is None or found[1] < match[1]):
+                    match = found
+                self.fingerprints.set_verdict(key, checked, match)
+                if match is None and batch:
+                    # 同じ回の中の重複も、先に並んでいる方だけを処理する（毎回変わるので記録しない）
+                    match = self.fingerprints.best_match(fingerprint, batch)
+            if match:
+                original, error_rate = match
+                if DEDUP_CONFIG['action'] == 'skip':
+                    print(f"  ℹ️ 「{original}」と同じ音声のためスキップ: {key}（一致 {1 - error_rate:.0%}）")
+                    continue
+                print(f"  ⚠️ 「{original}」と同じ音声の可能性: {key}（一致 {1 - error_rate:.0%}）")
+            elif title_matches[key] and fingerprint is not None:
+                print(f"  ℹ️ 同じタイトルの公開済みあり（音声は別物）: {key}")
+            result.append(key)
+            if fingerprint is not None:
+                batch[key] = fingerprint
+
+        try:
+            self.fingerprints.save()
+        except Exception as e:
+            print(f"  ⚠️ 指紋インデックスの保存エラー: {e}")
+        return result
+
+    def _select_unique(self, audio_files, count, refill=True):
+        """
+        先頭から count 本を、公開済みと重複するファイルを除いて選ぶ（処理する分だけ指紋を取る）
+        refill=False（時間予算で選んだ後）なら、除いた分を後ろのファイルで補わない
+        """
+        selected, batch = [], {}
+        rest = list(audio_files)
+        while rest and len(selected) < count:
+            window, rest = rest[:count - len(selected)], rest[count - len(selected):]
+            selected += self.skip_duplicates(window, batch)
+            if not refill:
+                break
+        return selected
+
+    def _transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(
+            multipart_threshold=DOWNLOAD_CONFIG['multipart_threshold'],
+            multipart_chunksize=DOWNLOAD_CONFIG['multipart_chunksize'],
+            max_concurrency=DOWNLOAD_CONFIG['max_concurrency'],
+        )
+
+    def _fetch_audio(self, key, local_path):
+        """分割・並列ダウンロード（先読みスレッドからも呼ぶ）"""
+        self.s3_client.download_file(
+            R2_CONFIG['bucket_name'], key, local_path, Config=self._transfer_config()
+        )
+
     def download_audio_from_r2(self, key, local_path):
-        """R2から音声ファイルダウンロード"""
-        self.s3_client.download_file(R2_CONFIG['bucket_name'], key, local_path)
+        """R2から音声ファイルダウンロード（先読み済みならそれを使う）"""
+        if self.prefetcher and self.prefetcher.take(key, local_path):
+            print(f"  ✓ 先読み済み: {key}")
+            return
+        self._fetch_audio(key, local_path)
         print(f"  ✓ ダウンロード完了: {key}")
 
+    def _needs_seek(self, key):
+        """MP4/M4A で moov が mdat より後ろにある（先頭から順に読めない）なら True"""
+        if not key.lower().endswith(('.m4a', '.mp4')):
+            return False
+
+        response = self.s3_client.get_object(
+            Bucket=R2_CONFIG['bucket_name'],
+            Key=key,
+            Range=f"bytes=0-{STREAM_CONFIG['head_bytes'] - 1}"
+        )
+        head = response['Body'].read()
+
+        # トップレベルのボックスを順にたどる
+        pos = 0
+        while pos + 8 <= len(head):
+            size = int.from_bytes(head[pos:pos + 4], 'big')
+            box = head[pos + 4:pos + 8]
+            if box == b'moov':
+                return False
+            if box == b'mdat':
+                return True
+            if size == 1:
+                size = int.from_bytes(head[pos + 8:pos + 16], 'big')
+            if size < 8:
+                break
+            pos += size
+        # 先頭で判定できなければ安全側（シーク可能な入力）に倒す
+        return True
+
+    def _feed_object(self, key, stdin):
+        """R2オブジェクトの本文を ffmpeg の stdin に流し込む"""
+        response = self.s3_client.get_object(Bucket=R2_CONFIG['bucket_name'], Key=key)
+        expected = response.get('ContentLength')
+        written = 0
+        for chunk in response['Body'].iter_chunks(STREAM_CONFIG['chunk_size']):
+            stdin.write(chunk)
+            written += len(chunk)
+        if expected is not None and written != expected:
+            raise IOError(f"{key}: {written}/{expected} バイトで途切れました")
+
+    def open_audio_stream(self, key):
+        """
+        R2の音声をディスクに置かずに ffmpeg へ渡す入力を用意
+        先頭から順に読める形式は stdin にパイプで流し、moov が末尾にある M4A は
+        署名付きURLを渡して ffmpeg 自身に HTTP レンジ要求でシークさせる（名前付きパイプはシークできないため）
+        戻り値: {'input': -i に渡す文字列, 'feed': stdin への書き込み関数 or None, 'probe': ffprobe 用URL}
+        """
+        url = self.s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': R2_CONFIG['bucket_name'], 'Key': key},
+            ExpiresIn=STREAM_CONFIG['url_expires']
+        )
+        if self._needs_seek(key):
+            print(f"  ℹ️ シークが必要な形式のため HTTP 経由で直接変換します")
+            return {'input': url, 'feed': None, 'probe': url}
+
+        print(f"  ℹ️ R2からパイプで直接変換します")
+        return {'input': 'pipe:0', 'feed': functools.partial(self._feed_object, key), 'probe': url}
+
+    def probe_remote_duration(self, key):
+        """R2上の音声の長さ（秒）。署名付きURLを ffprobe に渡すので、必要な部分しか読まない"""
+        url = self.s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': R2_CONFIG['bucket_name'], 'Key': key},
+            ExpiresIn=STREAM_CONFIG['url_expires']
+        )
+        info = self.probe_audio(url, quiet=True)
+        return info['duration'] if info else None
+
     def extract_title_from_filename(self, filename):
         """ファイル名からタイトル抽出（改良版）"""
         title = filename.rsplit('.', 1)[0]
@@ -279,87 +3322,164 @@ class YouTubeUploader:
 
     def generate_thumbnail(self, title, output_path):
         """サムネイル画像生成（自動サイズ調整付き）"""
-        img = Image.open(THUMBNAIL_CONFIG['template_image']).convert('RGB')
-        draw = ImageDraw.Draw(img)
-        
-        band_center_x = 640
-        max_width = 760
-        font_size = 90
-        font_path = THUMBNAIL_CONFIG['font_path']
-        
-        try:
-            font = ImageFont.truetype(font_path, font_size)
-        except:
-            font = ImageFont.load_default()
-            max_width = 999999
-        
-        bbox = draw.textbbox((0, 0), title, font=font)
-        text_width = bbox[2] - bbox[0]
-        
-        while text_width > max_width and font_size > 35:
-            font_size -= 5
-            try:
-                font = ImageFont.truetype(font_path, font_size)
-                bbox = draw.textbbox((0, 0), title, font=font)
-                text_width = bbox[2] - bbox[0]
-            except:
-                break
-        
-        if font_size >= 85:
-            band_center_y = 438
-        elif font_size >= 75:
-            band_center_y = 443
-        elif font_size >= 65:
-            band_center_y = 448
-        elif font_size >= 55:
-            band_center_y = 452
-        else:
-            band_center_y = 455
-        
-        text_height = bbox[3] - bbox[1]
-        x = band_center_x - text_width / 2
-        y = band_center_y - text_height / 2
-        
-        for offset_x in [-3, 0, 3]:
-            for offset_y in [-3, 0, 3]:
-                if offset_x != 0 or offset_y != 0:
-                    draw.text((x + offset_x, y + offset_y), title, font=font, fill='black')
-        
-        draw.text((x, y), title, font=font, fill=THUMBNAIL_CONFIG['text_color'])
-        img.save(output_path, quality=95)
+        font_size = self.thumbnail_renderer.render(title, output_path)
         print(f"  ✓ サムネイル生成完了 (font: {font_size}px)")
 
-    def convert_audio_to_video(self, audio_path, thumbnail_path, output_path):
-        """音声ファイルを静止画付き動画に変換"""
+    def probe_audio(self, audio_path, quiet=False):
+        """ffprobe で音声ストリームの情報を取得（失敗時は None）"""
         cmd = [
-            'ffmpeg',
-            '-loop', '1',
-            '-i', thumbnail_path,
-            '-i', audio_path,
-            '-c:v', 'libx264',
-            '-b:v', '1M',
-            '-r', '1',
-            '-af', 'volume=2.0',
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            '-pix_fmt', 'yuv420p',
-            '-shortest',
-            '-y',
-            output_path
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'a:0',
+            '-show_entries', 'stream=codec_name,sample_rate,channels:format=duration,bit_rate',
+            '-of', 'json',
+            audio_path
         ]
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            info = json.loads(result.stdout.decode('utf-8'))
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            if not quiet:
+                print(f"  ⚠️ ffprobe失敗: {e}")
+            return None
+
+        streams = info.get('streams') or [{}]
+        fmt = info.get('format', {})
+        return {
+            'codec': streams[0].get('codec_name'),
+            'sample_rate': streams[0].get('sample_rate'),
+            'channels': streams[0].get('channels'),
+            'duration': float(fmt['duration']) if fmt.get('duration') else None,
+            'bit_rate': int(fmt['bit_rate']) if fmt.get('bit_rate') else None,
+        }
+
+    def measure_loudness(self, audio_path):
+        """
+        EBU R128 のラウドネスを測る（loudnorm の解析結果。失敗時は None）
+        戻り値: {'input_i', 'input_tp', 'input_lra', 'input_thresh'}
+        """
+        cmd = [
+            'ffmpeg', '-hide_banner', '-nostats', '-i', audio_path, '-vn',
+            '-af', f"loudnorm=I={LOUDNESS_CONFIG['target_i']}:TP={LOUDNESS_CONFIG['target_tp']}:print_format=json",
+            '-f', 'null', '-'
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, check=True)
+            stderr = result.stderr.decode('utf-8', errors='replace')
+            report = json.loads(stderr[stderr.rindex('{'):stderr.rindex('}') + 1])
+            return {name: float(report[name]) for name in ('input_i', 'input_tp', 'input_lra', 'input_thresh')}
+        except (subprocess.CalledProcessError, OSError, ValueError, KeyError) as e:
+            print(f"  ⚠️ ラウドネス測定失敗: {e}")
+            return None
+
+    def _measure_and_store(self, key, etag, audio_path):
+        """測定済みでなければ audio_path のラウドネスを測って保存する（失敗時は None）"""
+        measurement = self.loudness.get(key, etag)
+        if measurement is not None:
+            return measurement
+        with self.metrics.stage('loudness', key=key):
+            measurement = self.measure_loudness(audio_path)
+        if measurement is not None and etag:
+            try:
+                self.loudness.put(key, etag, measurement)
+            except Exception as e:
+                print(f"  ⚠️ ラウドネス測定結果の保存エラー: {e}")
+        return measurement
+
+    def _prefetch_audio(self, key, local_path):
+        """先読みスレッドでダウンロードし、続けてラウドネスも測っておく（変換・アップロードと並行）"""
+        self._fetch_audio(key, local_path)
+        if LOUDNESS_CONFIG['enabled']:
+            self._measure_and_store(key, self.r2_objects.get(key, {}).get('etag'), local_path)
+
+    def _analyze_loudness(self, job):
+        """
+        ジョブの音声のラウドネスを測定結果から引く（通常は先読み時に測定済み）
+        ストリーミング入力では測るために全体をもう一度読むことになるので測らず、プロファイルの音量設定で変換する
+        """
+        if job['audio_stream']:
+            measurement = self.loudness.get(job['key'], job['etag'])
+            if measurement is None:
+                print(f"  ℹ️ ラウドネス未測定のため、プロファイルの音量設定で変換します")
+                return
+        else:
+            measurement = self._measure_and_store(job['key'], job['etag'], job['audio_path'])
+            if measurement is None:
+                return
+        job['gain_db'] = loudness_gain(measurement)
+        print(f"  🔊 ラウドネス {measurement['input_i']:.1f} LUFS（ピーク {measurement['input_tp']:.1f} dBTP）"
+              f" → 補正 {job['gain_db']:+.1f} dB")
+
+    def build_encode_command(self, audio_path, thumbnail_path, output_path, profile_name=None, probe_path=None,
+                             gain_db=None):
+        """
+        プロファイルに従って ffmpeg コマンドを組み立てる（audio_path は URL や pipe:0 でもよい）
+        gain_db（測定済みラウドネスからのゲイン）があれば、プロファイルの固定倍率の代わりに使う
+        """
+        profile = ENCODE_PROFILES[profile_name or self.encode_profile]
+
+        audio_args = list(profile['audio'])
+        if gain_db is not None:
+            needs_gain = abs(gain_db) > LOUDNESS_CONFIG['copy_tolerance_db']
+            volume = f'volume={gain_db}dB'
+        else:
+            needs_gain = profile['audio_gain'] != 1.0
+            volume = f"volume={profile['audio_gain']}"
+        if profile['audio_copy_codecs'] and not needs_gain:
+            probe = self.probe_audio(probe_path or audio_path)
+            if probe and probe['codec'] in profile['audio_copy_codecs']:
+                audio_args = ['-c:a', 'copy']
+                print(f"  ℹ️ 音声 {probe['codec']} をそのままコピーします")
+        if audio_args != ['-c:a', 'copy'] and needs_gain:
+            audio_args = ['-af', volume] + audio_args
+
+        audio_input = ['-i', audio_path]
+        if audio_path.startswith(('http://', 'https://')):
+            # HTTP 入力が途切れたときは再接続して続きから読む
+            audio_input = ['-reconnect', '1', '-reconnect_on_network_error', '1', '-reconnect_delay_max', '30'] + audio_input
+
+        output_args = []
+        if output_path == 'pipe:1':
+            # パイプにはシークできないので、moov を先頭に置いて断片毎に書き出す
+            output_args = ['-f', 'mp4', '-movflags', STREAM_CONFIG['output_movflags']]
+
+        return (
+            ['ffmpeg']
+            + profile['image_input']
+            + ['-i', thumbnail_path]
+            + audio_input
+            + profile['video']
+            + audio_args
+            + ['-pix_fmt', 'yuv420p', '-shortest']
+            + output_args
+            + ['-y', output_path]
+        )
+
+    def convert_audio_to_video(self, audio_path, thumbnail_path, output_path, stream=None, gain_db=None,
+                               stdout_sink=None):
+        """
+        音声ファイルを静止画付き動画に変換（stream は open_audio_stream の戻り値）
+        output_path が 'pipe:1' なら fragmented MP4 を標準出力に書き、stdout_sink(pipe) に読ませる
+        """
+        if stream:
+            cmd = self.build_encode_command(
+                stream['input'], thumbnail_path, output_path, probe_path=stream['probe'], gain_db=gain_db
+            )
+        else:
+            cmd = self.build_encode_command(audio_path, thumbnail_path, output_path, gain_db=gain_db)
 
         print(f"  🎬 動画変換中...")
         try:
-            result = subprocess.run(
+            encoded = self.transcoder.run(
                 cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=True
+                label=os.path.basename(audio_path),
+                stdin_feed=stream['feed'] if stream else None,
+                stdout_sink=stdout_sink
             )
             print(f"  ✓ 動画変換完了")
+            return encoded
         except subprocess.CalledProcessError as e:
             print(f"  ❌ 動画変換エラー: {e}")
-            print(f"  stderr: {e.stderr.decode()}")
+            print(f"  stderr: {e.stderr.decode(errors='replace')}")
             raise
 
     def create_description(self, title):
@@ -381,8 +3501,116 @@ class YouTubeUploader:
 
         return publish_date
 
-    def upload_to_youtube(self, video_path, thumbnail_path, title, description, publish_date):
-        """YouTubeにアップロード"""
+    def _next_chunk_size(self, current, sent_bytes, elapsed):
+        """実測スループットから次のチャンクサイズを決める（256KiB単位）"""
+        if sent_bytes <= 0 or elapsed <= 0:
+            return current
+        unit = 256 * 1024
+        target = sent_bytes / elapsed * UPLOAD_CONFIG['target_chunk_seconds']
+        # 急に振れないよう現在値との平均をとる
+        size = int((current + target) / 2) // unit * unit
+        return max(UPLOAD_CONFIG['min_chunk_size'], min(UPLOAD_CONFIG['max_chunk_size'], size))
+
+    def _retry_wait(self, attempt, error):
+        """指数バックオフ（ジッター付き）で待つ。上限を超えたら例外を投げ直す"""
+        if attempt > UPLOAD_CONFIG['max_retries']:
+            raise error
+        wait = min(UPLOAD_CONFIG['retry_max_seconds'], UPLOAD_CONFIG['retry_base_seconds'] * 2 ** (attempt - 1))
+        wait *= random.uniform(0.5, 1.0)
+        print(f"\n  ⚠️ 送信エラー（{attempt}回目、{wait:.0f}秒後に再試行）: {error}")
+        time.sleep(wait)
+
+    def _upload_resumable(self, request, media, session_id=None, publish_at=None, stream=None, slot=None):
+        """
+        再開可能アップロードをチャンク毎に送信
+        5xx・接続エラーは指数バックオフで再試行し、セッションURIと送信済みバイト数をR2に保存する
+        stream（EncodedStream）を渡すと、変換の出力が溜まるのを待ちながら送り、送信確定分をバッファから捨てる
+        """
+        from googleapiclient.errors import HttpError
+
+        saved = self.upload_sessions.get(session_id)
+        if saved and saved.get('size') == media.size():
+            # 保存済みURIに現在位置を問い合わせるところから始める（googleapiclient のエラー復帰と同じ手順）
+            request.resumable_uri = saved['uri']
+            request.resumable_progress = saved.get('offset', 0)
+            request._in_error_state = True
+            print(f"  🔁 前回のアップロードを再開します ({saved.get('offset', 0) * 100 // media.size()}%)")
+            if saved.get('publish_at') and saved['publish_at'] != publish_at:
+                print(f"  ℹ️ 公開予定は作成時の {saved['publish_at']} のままになります")
+        else:
+            # videos.insert が課金されるのは新しいセッションを作るときだけ（再開は課金されない）
+            self.quota.charge('videos.insert')
+
+        attempt = 0
+        response = None
+        while response is None:
+            if stream:
+                stream.wait_ready(request.resumable_progress, media.chunksize())
+            started = time.monotonic()
+            offset = request.resumable_progress
+            try:
+                status, response = request.next_chunk()
+            except HttpError as e:
+                if saved and e.resp.status in (404, 410):
+                    # 再開用URIが失効している → 最初から送り直す
+                    print(f"\n  ⚠️ 再開用セッションが失効しているため最初から送信します")
+                    self.upload_sessions.drop(session_id)
+                    self.quota.charge('videos.insert')
+                    saved = None
+                    request.resumable_uri = None
+                    request.resumable_progress = 0
+                    request._in_error_state = False
+                    continue
+                if e.resp.status not in RETRYABLE_STATUS_CODES and not is_rate_limit_error(e):
+                    raise
+                attempt += 1
+                self._retry_wait(attempt, e)
+                continue
+            except retryable_exceptions() as e:
+                attempt += 1
+                self._retry_wait(attempt, e)
+                continue
+
+            attempt = 0
+            if response is not None:
+                break
+
+            if stream:
+                stream.release(request.resumable_progress)
+            media._chunksize = self._next_chunk_size(
+                media.chunksize(), request.resumable_progress - offset, time.monotonic() - started
+            )
+            self.upload_sessions.update(
+                session_id,
+                uri=request.resumable_uri,
+                offset=request.resumable_progress,
+                size=media.size(),
+                publish_at=publish_at,
+                slot=slot,
+            )
+            if status and media.size() is None:
+                # 変換中で全体サイズが未定
+                print(f"  ... {request.resumable_progress // (1024 * 1024)}MB 送信 (chunk {media.chunksize() // (1024 * 1024)}MB)", end='\r')
+            elif status:
+                progress = int(status.progress() * 100)
+                print(f"  ... {progress}% (chunk {media.chunksize() // (1024 * 1024)}MB)", end='\r')
+            if self.shutdown.is_set() and session_id:
+                # 再開情報は保存済みなので、次回はこの位置から続けられる
+                raise ShutdownRequested(f"停止要求によりアップロードを中断（{request.resumable_progress * 100 // media.size()}%、次回再開）")
+
+        self.upload_sessions.drop(session_id)
+        return response
+
+    def upload_to_youtube(self, video_path, title, description, publish_date, session_id=None, stream=None,
+                          slot=None):
+        """
+        YouTubeに動画をアップロードして動画IDを返す（失敗時は None）
+        stream（EncodedStream）を渡すと video_path の代わりに変換中の出力を送る。
+        slot は再開情報に残し、再開時に同じ公開枠を使う
+        """
+        from googleapiclient.errors import HttpError
+        from googleapiclient.http import MediaFileUpload
+
         publish_at = publish_date.strftime("%Y-%m-%dT%H:%M:%S+09:00")
 
         body = {
@@ -399,7 +3627,10 @@ class YouTubeUploader:
             }
         }
 
-        media = MediaFileUpload(video_path, chunksize=-1, resumable=True)
+        if stream:
+            media = streaming_media_upload(stream, UPLOAD_CONFIG['chunk_size'])
+        else:
+            media = MediaFileUpload(video_path, chunksize=UPLOAD_CONFIG['chunk_size'], resumable=True)
 
         try:
             print(f"  📤 YouTubeにアップロード中...")
@@ -409,86 +3640,768 @@ class YouTubeUploader:
                 media_body=media
             )
 
-            response = None
-            while response is None:
-                status, response = request.next_chunk()
-                if status:
-                    progress = int(status.progress() * 100)
-                    print(f"  ... {progress}%", end='\r')
+            with self.metrics.stage('upload', nbytes=media.size() or 0) as event:
+                response = self._upload_resumable(request, media, session_id, publish_at, stream=stream, slot=slot)
+                event['bytes'] = media.size() or 0
+
+        except HttpError as e:
+            self._check_quota_error(e)
+            print(f"  ❌ YouTubeエラー: {e}")
+            return None
+
+        video_id = response['id']
+        print(f"\n  ✓ 動画アップロード完了: https://youtube.com/watch?v={video_id}")
+        return video_id
 
-            video_id = response['id']
-            print(f"\n  ✓ 動画アップロード完了: https://youtube.com/watch?v={video_id}")
+    def set_thumbnail(self, video_id, thumbnail_path):
+        """サムネイルを設定。成功したら True"""
+        from googleapiclient.errors import HttpError
+        from googleapiclient.http import MediaFileUpload
 
+        try:
             print(f"  🖼️ サムネイル設定中...")
-            self.youtube.thumbnails().set(
-                videoId=video_id,
-                media_body=MediaFileUpload(thumbnail_path)
-            ).execute()
-            print(f"  ✓ サムネイル設定完了")
+            self.quota.charge('thumbnails.set')
+            with self.metrics.stage('thumbnail_set', nbytes=os.path.getsize(thumbnail_path)):
+                self.youtube.thumbnails().set(
+                    videoId=video_id,
+                    media_body=MediaFileUpload(thumbnail_path)
+                ).execute(num_retries=UPLOAD_CONFIG['max_retries'])
+        except HttpError as e:
+            self._check_quota_error(e)
+            print(f"  ⚠️ サムネイル設定エラー（次回サムネイルだけ設定し直します）: {e}")
+            return False
+        print(f"  ✓ サムネイル設定完了")
+        return True
 
-            return video_id
+    def _check_quota_error(self, error):
+        """クォータ切れなら記録して QuotaExceededError を投げる"""
+        if not is_quota_error(error):
+            return
+        self.quota_stop.set()
+        self.quota.exhaust()
+        print(f"  🛑 YouTube APIのクォータが尽きました（{self.quota.reset_time().strftime('%m/%d %H:%M')} に回復）")
+        raise QuotaExceededError("YouTube APIのクォータ切れ") from error
 
-        except googleapiclient.errors.HttpError as e:
-            print(f"  ❌ YouTubeエラー: {e}")
-            return None
+    def reconcile_channel(self, audio_files):
+        """
+        チャンネルにあるのに履歴に無い動画（アップロード直後の異常終了など）を探して履歴に記録する
+        タイトル「昔話【…】」で未公開のファイルと対応づけ、記録したファイルを除いた一覧を返す
+        """
+        from googleapiclient.errors import HttpError
 
-    def process_batch(self, limit=None):
-        """バッチ処理実行"""
-        audio_files = self.get_audio_files_from_r2()
+        print("🔎 チャンネルの動画と履歴を照合中...")
+        reconciler = ChannelReconciler(self.youtube, self.quota)
+        try:
+            uploads = reconciler.list_uploads()
+            known = {r.get('video_id') for r in self.history.records.values() if r.get('video_id')}
+            # アップロード済みでサムネイル設定・記録待ちの動画は、進捗から続きを行う
+            known |= self.file_states.video_ids()
+            orphans = [v for v in uploads if v['video_id'] not in known]
+            items = reconciler.fetch_status([v['video_id'] for v in orphans], part='status') if orphans else {}
+        except HttpError as e:
+            try:
+                self._check_quota_error(e)
+            except QuotaExceededError:
+                return audio_files
+            if e.resp.status in (401, 403):
+                print(f"  ⚠️ 照合をスキップ: トークンに youtube.readonly スコープがありません（{e.resp.status}）。"
+                      f"ローカルで --reconcile を付けて実行すると再認証します")
+            else:
+                print(f"  ⚠️ 照合をスキップ: {e}")
+            return audio_files
 
-        if limit:
-            audio_files = audio_files[:limit]
+        # タイトル → 未公開ファイル（同名が複数あれば一覧順に割り当てる）
+        by_title = {}
+        for key in audio_files:
+            by_title.setdefault(f"昔話【{self.extract_title_from_filename(key)}】", []).append(key)
 
-        total = len(audio_files)
-        print(f"\n📊 処理対象: {total}ファイル")
-        print(f"📊 既に公開済み: {len(self.published_list)}ファイル")
-        print("=" * 60)
+        # 動画IDの無い古い履歴（公開済み）も同じタイトルの動画を持っているはず。
+        # その分は古い順に先に消費し、「鬼の面(2).m4a」を「鬼の面.m4a」の動画と取り違えないようにする
+        legacy = {}
+        for key in self.published_list:
+            if not self.history.records.get(key, {}).get('video_id'):
+                title = f"昔話【{self.extract_title_from_filename(key)}】"
+                legacy[title] = legacy.get(title, 0) + 1
 
-        for index, audio_key in enumerate(audio_files):
-            print(f"\n[{index + 1}/{total}] 処理中: {audio_key}")
+        recovered = set()
+        # 古い順に割り当てる
+        for video in reversed(orphans):
+            if legacy.get(video['title']):
+                legacy[video['title']] -= 1
+                continue
+            item = items.get(video['video_id'])
+            if item is None or item['status'].get('uploadStatus') in ('failed', 'rejected', 'deleted'):
+                continue
+            keys = by_title.get(video['title'])
+            if not keys:
+                continue
+            key = keys.pop(0)
+            print(f"  🔗 履歴に無い動画を記録: {key} → {video['video_id']}")
+            self._save_published(
+                key,
+                video_id=video['video_id'],
+                publish_at=item['status'].get('publishAt'),
+                etag=self.r2_objects.get(key, {}).get('etag')
+            )
+            recovered.add(key)
+
+        print(f"  ✓ 照合完了: チャンネル {len(uploads)}本 / 履歴に無い動画 {len(orphans)}本 / 記録 {len(recovered)}本")
+        return [key for key in audio_files if key not in recovered]
+
+    def check_recent_uploads(self, since=None):
+        """履歴の動画（since 以降にアップロードしたもの、既定は status_days 日以内）の処理状況を確認"""
+        from googleapiclient.errors import HttpError
+
+        if since is None:
+            since = time.time() - RECONCILE_CONFIG['status_days'] * 86400
+        video_ids = [
+            r['video_id'] for r in self.history.records.values()
+            if r.get('video_id') and r.get('at', 0) >= since
+        ]
+        if not video_ids:
+            return []
+        print(f"\n🔎 動画の処理状況を確認中 ({len(video_ids)}本)...")
+        try:
+            return ChannelReconciler(self.youtube, self.quota).wait_for_processing(video_ids)
+        except HttpError as e:
+            try:
+                self._check_quota_error(e)
+            except QuotaExceededError:
+                return video_ids
+            print(f"  ⚠️ 処理状況を確認できません: {e}")
+            return video_ids
 
+    def prerender_thumbnails(self):
+        """未公開ファイル全件のサムネイルを事前生成してR2に置く"""
+        audio_files = self.get_audio_files_from_r2()
+        items = []
+        for audio_key in audio_files:
             title = self.extract_title_from_filename(audio_key)
+            items.append((audio_key, title, ArtifactCache.make_key('thumbnail', title, self._thumbnail_settings())))
+        with tempfile.TemporaryDirectory() as workdir, self.metrics.stage('prerender') as event:
+            event['files'] = self.prerendered.run(items, workdir)
+        self.metrics.finish()
 
-            with tempfile.TemporaryDirectory() as tmpdir:
-                audio_path = os.path.join(tmpdir, audio_key)
-                thumbnail_path = os.path.join(tmpdir, 'thumbnail.png')
-                video_path = os.path.join(tmpdir, 'video.mp4')
+    def _thumbnail_settings(self):
+        """サムネイルのキャッシュキー用設定（テンプレート画像の中身も含める）"""
+        if self._thumbnail_settings_cache is None:
+            with open(THUMBNAIL_CONFIG['template_image'], 'rb') as f:
+                template_hash = hashlib.sha256(f.read()).hexdigest()
+            self._thumbnail_settings_cache = {'config': THUMBNAIL_CONFIG, 'template': template_hash}
+        return self._thumbnail_settings_cache
 
-                try:
-                    self.download_audio_from_r2(audio_key, audio_path)
-                    self.generate_thumbnail(title, thumbnail_path)
-                    self.convert_audio_to_video(audio_path, thumbnail_path, video_path)
-                    
-                    description = self.create_description(title)
-                    current_published_count = len(self.published_list)
-                    publish_date = self.calculate_publish_date(current_published_count)
-
-                    print(f"  📅 公開予定: {publish_date.strftime('%Y-%m-%d %H:%M')}")
-
-                    video_id = self.upload_to_youtube(
-                        video_path,
-                        thumbnail_path,
-                        title,
-                        description,
-                        publish_date
+    def _new_job(self, index, audio_key, workdir):
+        """1ファイル分の処理状態"""
+        with self.metrics.stage('title', key=audio_key):
+            title = self.extract_title_from_filename(audio_key)
+        etag = self.r2_objects.get(audio_key, {}).get('etag')
+
+        thumbnail_key = video_key = None
+        if etag:
+            thumbnail_key = ArtifactCache.make_key('thumbnail', title, self._thumbnail_settings())
+            video_key = ArtifactCache.make_key(
+                'video', etag, title, thumbnail_key, self.encode_profile, ENCODE_PROFILES[self.encode_profile],
+                LOUDNESS_CONFIG
+            )
+
+        return {
+            'index': index,
+            'key': audio_key,
+            'etag': etag,
+            'title': title,
+            'workdir': workdir,
+            'audio_path': os.path.join(workdir, os.path.basename(audio_key)),
+            'thumbnail_path': os.path.join(workdir, 'thumbnail.png'),
+            'video_path': os.path.join(workdir, 'video.mp4'),
+            'thumbnail_cache_key': thumbnail_key,
+            'video_cache_key': video_key,
+            'video_cached': False,
+            'audio_stream': None,
+            'gain_db': None,
+            'video_id': None,
+            'publish_at': None,
+            'state': {},
+            'error': None,
+            'failed_stage': None,
+        }
+
+    def _publish_cost(self, key):
+        """公開まで残りのAPI費用（前回アップロード済みなら、サムネイル設定や履歴記録の分だけ）"""
+        entry = self.file_states.get(key)
+        if FileStateStore.reached(entry, 'thumbnail_set'):
+            return 0
+        if FileStateStore.reached(entry, 'uploaded'):
+            return self.quota.cost('thumbnails.set')
+        return self.quota.per_file_cost()
+
+    def _restore_job_state(self, job):
+        """
+        前回までに済んだ段階を引き継ぐ（動画アップロード済みなら動画ID・公開予定も）
+        encoded なら、元ファイルが同じ限り前回の変換済み動画のキャッシュキーを使う
+        """
+        entry = self.file_states.get(job['key'])
+        job['state'] = entry
+        if FileStateStore.reached(entry, 'uploaded'):
+            job['video_id'] = entry['video_id']
+            job['publish_at'] = entry.get('publish_at')
+            print(f"  ↪️ 前回の続きから: {entry['state']} (動画 {entry['video_id']})")
+        elif (entry.get('state') == 'encoded' and entry.get('video_cache_key')
+              and entry.get('etag') == job['etag'] and entry['video_cache_key'] != job['video_cache_key']
+              and self.cache.get('video', entry['video_cache_key'], '.mp4')):
+            # 変換設定が変わっていても、変換済みの動画（と途中までのアップロード）を捨てない
+            job['video_cache_key'] = entry['video_cache_key']
+            print(f"  ↪️ 前回の変換結果から再開します")
+        return job
+
+    def _forget_unfinished(self, job):
+        """
+        アップロードより前の段階で失敗したファイルの進捗を消す（変換済み動画が無いので残しても再開できない）
+        アップロード段階の失敗では、encoded の記録を次回の再開に残す
+        """
+        if job['video_id'] or job['failed_stage'] in (None, 'upload') or not job['state']:
+            return
+        try:
+            self.file_states.forget([job['key']])
+        except Exception as e:
+            print(f"  ⚠️ 進捗の削除エラー: {e}")
+
+    def _stage_download(self, job):
+        if self.quota_stop.is_set():
+            if self.prefetcher:
+                self.prefetcher.discard(job['key'])
+            raise QuotaExceededError("クォータ切れのため処理しません")
+        if job['video_id']:
+            # 動画はアップロード済み。音声も動画も要らない
+            if self.prefetcher:
+                self.prefetcher.discard(job['key'])
+            return
+        # 変換済み動画がキャッシュにあればダウンロードも変換も不要
+        cached = self.cache.get('video', job['video_cache_key'], '.mp4')
+        if cached:
+            if self.prefetcher:
+                self.prefetcher.discard(job['key'])
+            job['video_path'] = cached
+            job['video_cached'] = True
+            print(f"  ✓ 変換済み動画をキャッシュから再利用: {job['key']}")
+            return
+        if self.stream_input:
+            # ダウンロードせず、変換時にR2から直接読む
+            job['audio_stream'] = self.open_audio_stream(job['key'])
+        else:
+            with self.metrics.stage('download') as event:
+                self.download_audio_from_r2(job['key'], job['audio_path'])
+                event['bytes'] = os.path.getsize(job['audio_path'])
+        if LOUDNESS_CONFIG['enabled']:
+            self._analyze_loudness(job)
+
+    def _stage_thumbnail(self, job):
+        if FileStateStore.reached(job['state'], 'thumbnail_set'):
+            return
+        cached = self.cache.get('thumbnail', job['thumbnail_cache_key'], '.png')
+        if cached:
+            job['thumbnail_path'] = cached
+            print(f"  ✓ サムネイルをキャッシュから再利用")
+            return
+        jpeg_path = os.path.join(job['workdir'], 'thumbnail.jpg')
+        with self.metrics.stage('thumbnail_fetch') as event:
+            fetched = self.prerendered.fetch(job['key'], job['thumbnail_cache_key'], jpeg_path)
+            if fetched:
+                event['bytes'] = os.path.getsize(jpeg_path)
+        if fetched:
+            job['thumbnail_path'] = jpeg_path
+            print(f"  ✓ 事前生成サムネイルを使用 ({os.path.getsize(jpeg_path) // 1024}KB)")
+            return
+        with self.metrics.stage('thumbnail') as event:
+            self.generate_thumbnail(job['title'], job['thumbnail_path'])
+            event['bytes'] = os.path.getsize(job['thumbnail_path'])
+        job['thumbnail_path'] = self.cache.put('thumbnail', job['thumbnail_cache_key'], job['thumbnail_path'], '.png')
+
+    def _stage_encode(self, job):
+        if job['video_cached'] or job['video_id']:
+            return
+        if self.stream_output:
+            # アップロード段階で、変換しながら送る
+            return
+        with self.metrics.stage('encode') as event:
+            event['audio_seconds'] = self.convert_audio_to_video(
+                job['audio_path'], job['thumbnail_path'], job['video_path'], stream=job['audio_stream'],
+                gain_db=job['gain_db']
+            )
+            event['bytes'] = os.path.getsize(job['video_path'])
+        job['video_path'] = self.cache.put('video', job['video_cache_key'], job['video_path'], '.mp4')
+        self.file_states.advance(job['key'], 'encoded', etag=job['etag'], video_cache_key=job['video_cache_key'])
+
+    def _stage_upload(self, job):
+        """
+        公開枠を予約してアップロードし、サムネイルを設定して履歴に記録
+        前回アップロード済み（job['video_id'] あり）なら残りの段階だけ行う
+        """
+        if self.quota_stop.is_set():
+            raise QuotaExceededError("クォータ切れのためアップロードしません")
+        if self.leases and not self.leases.holds(job['key']):
+            raise RuntimeError("リースを失ったためアップロードしません（他ノードが処理します）")
+
+        if not job['video_id']:
+            self._upload_video(job)
+            if not job['video_id']:
+                print(f"  ❌ アップロード失敗")
+                return
+
+        if not FileStateStore.reached(job['state'], 'thumbnail_set'):
+            if not self.set_thumbnail(job['video_id'], job['thumbnail_path']):
+                # 動画は残したまま。次回はサムネイル設定からやり直す
+                raise RuntimeError("サムネイル設定に失敗しました")
+            job['state'] = {'state': 'thumbnail_set'}
+            self.file_states.advance(job['key'], 'thumbnail_set')
+
+        with self._slot_lock:
+            # 履歴への記録と進捗の削除をまとめて行い、公開枠の数え方がずれないようにする
+            saved = self._save_published(
+                job['key'],
+                video_id=job['video_id'],
+                publish_at=job['publish_at'],
+                etag=job['etag']
+            )
+            if saved:
+                self.file_states.advance(job['key'], 'recorded')
+                # 公開済みの動画は二度と送らないので、キャッシュ（と次回の actions/cache）から外す
+                self.cache.discard('video', job['video_cache_key'], '.mp4')
+            else:
+                # 進捗に動画IDが残っているので、次回は記録だけをやり直す
+                print(f"  ⚠️ 次回、履歴への記録だけをやり直します")
+        print(f"  ✅ 完了")
+
+    def _saved_session(self, job):
+        """
+        続きから送れる前回のアップロードセッション（無ければ None）
+        再開はキャッシュ上の同一ファイルを送るときだけ（再変換したファイルはバイト列が一致しない）
+        """
+        if not CACHE_CONFIG['enabled'] or (self.stream_output and not job['video_cached']):
+            return None
+        saved = self.upload_sessions.get(job['video_cache_key'])
+        if not saved or saved.get('slot') is None or not saved.get('publish_at'):
+            return None
+        if saved.get('size') != os.path.getsize(job['video_path']):
+            return None
+        return saved
+
+    def _upload_video(self, job):
+        """
+        公開枠を予約して動画をアップロードし、成功したら uploaded として動画IDを残す
+        前回のセッションを再開するときは、YouTube 側に作成済みの公開予定とその枠をそのまま使う
+        """
+        description = self.create_description(job['title'])
+        saved = self._saved_session(job)
+
+        # 枠番号 = 公開済み数 + 履歴未記録のアップロード済み数 + アップロード中の本数
+        # （予約ではなく数なので、--coordinate 無しではアップロードを1並列に限っている）
+        with self._slot_lock:
+            if saved:
+                slot = saved['slot']
+            else:
+                slot = (len(self.published_list) + self.file_states.pending_uploads(self.published_list)
+                        + self._uploads_in_flight)
+            self._uploads_in_flight += 1
+        if self.leases:
+            # 他ノードと重ならないよう、R2上で空いている枠を予約する
+            start = saved['slot'] if saved else len(self.published_list)
+            slot = self.leases.claim_slot(start, job['key'], self.published_list)
+            if saved and slot != saved['slot']:
+                # 前回の枠は他ノードが使った。同じ公開予定で続けると重なるので最初から送る
+                print(f"  ⚠️ 前回の公開枠が使われているため、アップロードを最初からやり直します")
+                self.upload_sessions.drop(job['video_cache_key'])
+                saved = None
+
+        video_id = None
+        try:
+            if saved:
+                publish_at = saved['publish_at']
+                publish_date = datetime.strptime(publish_at, "%Y-%m-%dT%H:%M:%S+09:00")
+            else:
+                publish_date = self.calculate_publish_date(slot)
+                publish_at = publish_date.strftime("%Y-%m-%dT%H:%M:%S+09:00")
+            print(f"  📅 公開予定: {publish_date.strftime('%Y-%m-%d %H:%M')}")
+
+            if self.stream_output and not job['video_cached']:
+                video_id = self._upload_while_encoding(job, description, publish_date)
+            else:
+                video_id = self.upload_to_youtube(
+                    job['video_path'],
+                    job['title'],
+                    description,
+                    publish_date,
+                    session_id=job['video_cache_key'] if CACHE_CONFIG['enabled'] else None,
+                    slot=slot
+                )
+        finally:
+            if self.leases:
+                if video_id:
+                    self.leases.complete_slot(slot, video_id)
+                else:
+                    self.leases.release_slot(slot)
+            with self._slot_lock:
+                self._uploads_in_flight -= 1
+                if video_id:
+                    # 枠は「履歴未記録のアップロード済み」として数え続ける
+                    job['video_id'] = video_id
+                    job['publish_at'] = publish_at
+                    job['state'] = {'state': 'uploaded', 'video_id': video_id}
+                    self.file_states.advance(
+                        job['key'], 'uploaded', video_id=video_id, publish_at=publish_at, slot=slot, etag=job['etag']
                     )
 
-                    if video_id:
-                        self._save_published(audio_key)
-                        print(f"  ✅ 完了")
-                    else:
-                        print(f"  ❌ アップロード失敗")
+    def _encode_to_stream(self, job, stream):
+        """動画を fragmented MP4 として stream に書き出す（アップロードと並行して別スレッドで動かす）"""
+        try:
+            with self.metrics.stage('encode', key=job['key']) as event:
+                event['audio_seconds'] = self.convert_audio_to_video(
+                    job['audio_path'], job['thumbnail_path'], 'pipe:1', stream=job['audio_stream'],
+                    gain_db=job['gain_db'], stdout_sink=stream.fill
+                )
+                event['bytes'] = stream.size() or 0
+        except Exception as e:
+            stream.fail(e)
+
+    def _upload_while_encoding(self, job, description, publish_date):
+        """
+        変換とアップロードを同時に行う（動画ファイルをディスクに置かない）
+        バイト列が実行毎に同じとは限らないので、再開情報は保存しない。
+        変換が失敗したときは encode 段階の失敗として ffmpeg のエラーを投げ直す（失敗台帳で数える）
+        """
+        stream = EncodedStream()
+        encoder = threading.Thread(target=self._encode_to_stream, args=(job, stream), daemon=True)
+        encoder.start()
+        try:
+            video_id = self.upload_to_youtube(
+                None, job['title'], description, publish_date, stream=stream
+            )
+        finally:
+            # アップロードが失敗したら出力を読むのをやめ、ffmpeg を終わらせる
+            stream.close()
+            encoder.join()
+            error = stream.error()
+            if error is not None:
+                job['failed_stage'] = 'encode'
+                raise error
+        return video_id
+
+    def _record_failure(self, job, error):
+        """元ファイルが原因になりうる段階の失敗を失敗台帳に記録し、規定回数で隔離する"""
+        if job['failed_stage'] not in FAILURE_CONFIG['counted_stages']:
+            return
+        # ffmpeg の失敗はコマンド全体ではなく stderr の最終行を残す
+        stderr = getattr(error, 'stderr', None)
+        if isinstance(stderr, bytes) and stderr.strip():
+            error = stderr.decode('utf-8', errors='replace').strip().splitlines()[-1]
+        try:
+            entry = self.history.record_failure(job['key'], job['failed_stage'], error, etag=job['etag'])
+        except Exception as e:
+            print(f"  ⚠️ 失敗台帳の記録エラー: {e}")
+            return
+        if entry['count'] >= FAILURE_CONFIG['quarantine_after']:
+            print(f"  🚫 {entry['count']}回失敗したため隔離しました: {job['key']}（解除: --release）")
+        else:
+            print(f"  📝 失敗{entry['count']}回目を記録しました: {job['key']}")
+
+    def print_quarantine(self):
+        """隔離中のファイル一覧を表示"""
+        quarantined = self.history.quarantined()
+        if not quarantined:
+            print("✓ 隔離中のファイルはありません")
+            return
+        print(f"🚫 隔離中: {len(quarantined)}ファイル")
+        for filename, entry in quarantined.items():
+            when = datetime.fromtimestamp(entry['last_at']).strftime('%Y-%m-%d %H:%M') if entry['last_at'] else '-'
+            count = f"{entry['count']}回" if entry['count'] else '-'
+            print(f"  {filename}  失敗{count}  最終 {when}  [{entry['stage'] or '-'}] {entry['last_error']}")
+
+    def _bind_job(self, func):
+        """ステージ関数の中で記録する計測イベントにファイル名を付ける"""
+        def run(job):
+            with self.metrics.bind(job['key']):
+                return func(job)
+        return run
+
+    def _batch_stages(self):
+        """(ステージ名, 関数) の処理順"""
+        return [
+            (name, self._bind_job(func)) for name, func in (
+                ('download', self._stage_download),
+                ('thumbnail', self._stage_thumbnail),
+                ('encode', self._stage_encode),
+                ('upload', self._stage_upload),
+            )
+        ]
+
+    def _process_sequential(self, audio_files):
+        """1ファイルずつ全ステージを順に実行"""
+        total = len(audio_files)
+        for index, audio_key in enumerate(audio_files):
+            if self.shutdown.is_set():
+                print(f"\n🛑 停止要求のため残り{total - index}ファイルは次回に回します")
+                break
+            print(f"\n[{index + 1}/{total}] 処理中: {audio_key}")
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                job = self._restore_job_state(self._new_job(index, audio_key, tmpdir))
+                try:
+                    for name, stage in self._batch_stages():
+                        job['failed_stage'] = name
+                        stage(job)
+                    job['failed_stage'] = None
 
+                except (QuotaExceededError, ShutdownRequested) as e:
+                    print(f"  🛑 {e}。残り{total - index - 1}ファイルは次回に回します")
+                    break
                 except Exception as e:
                     print(f"  ❌ エラー: {e}")
-                    import traceback
                     traceback.print_exc()
+                    self._record_failure(job, e)
+                    self._forget_unfinished(job)
                     continue
 
+    def _process_pipelined(self, audio_files, workers=None):
+        """ダウンロード・サムネイル・変換・アップロードを重ねて実行"""
+        workers = dict(PIPELINE_CONFIG['workers'], **(workers or {}))
+        if workers['encode'] != self.transcoder.max_jobs:
+            self.transcoder = TranscodePool(max_jobs=workers['encode'])
+        # クライアントを作ってからスレッドセーフか判定する（作成は初回アクセス時）
+        youtube = self.youtube
+        if workers['upload'] > 1 and (youtube is None or not self.thread_safe_client):
+            print("  ⚠️ YouTubeクライアントがスレッドセーフでないためアップロードは1並列で実行します")
+            workers['upload'] = 1
+        if workers['upload'] > 1 and not self.leases:
+            # 公開枠は「公開済み + 未記録 + 送信中」の本数で決めるので、並列だと失敗で空いた枠を
+            # 後の本と重ねて使いかねない。枠を予約できる --coordinate のときだけ並列にする
+            print("  ⚠️ 公開枠の予約（--coordinate）が無効なため、アップロードは1並列で実行します")
+            workers['upload'] = 1
+
+        total = len(audio_files)
+        with tempfile.TemporaryDirectory() as run_dir:
+
+            def jobs():
+                for index, audio_key in enumerate(audio_files):
+                    if self.shutdown.is_set():
+                        # 投入済みのジョブだけ最後まで流す
+                        print(f"\n🛑 停止要求のため残り{total - index}ファイルは投入しません")
+                        return
+                    print(f"\n[{index + 1}/{total}] 投入: {audio_key}")
+                    yield self._restore_job_state(self._new_job(index, audio_key, tempfile.mkdtemp(dir=run_dir)))
+
+            def finish(job):
+                # 後始末（ジョブ毎の作業ディレクトリを消してディスクを空ける）
+                shutil.rmtree(job['workdir'], ignore_errors=True)
+                if job['failed_stage']:
+                    self._record_failure(job, job['error'])
+                    self._forget_unfinished(job)
+                state = '✅' if job['video_id'] else '❌'
+                print(f"  {state} [{job['index'] + 1}/{total}] {job['key']}")
+
+            # アップロードは入力順に流し、公開枠の順序を従来どおりに保つ
+            stages = [
+                (name, func, workers[name], name == 'upload')
+                for name, func in self._batch_stages()
+            ]
+            StagedPipeline(stages, PIPELINE_CONFIG['queue_size'], on_finish=finish).run(jobs())
+
+    def _claim_files(self, audio_files, count):
+        """
+        先頭から順にリースを取り、他ノードが処理中のファイルを飛ばして count 本を確保する
+        リース取得前に他ノードが公開し終えたファイルは、履歴を読み直して除く
+        """
+        self.leases.start()
+        candidates = iter(audio_files)
+        claimed = []
+        while len(claimed) < count:
+            batch = []
+            for key in candidates:
+                if self.leases.acquire(key):
+                    batch.append(key)
+                    if len(claimed) + len(batch) >= count:
+                        break
+                else:
+                    print(f"  ⏭️ 他ノードが処理中: {key}")
+            if not batch:
+                break
+
+            self.history.load()
+            for key in batch:
+                if key in self.published_list:
+                    print(f"  ⏭️ 他ノードが公開済み: {key}")
+                    self.leases.release(key)
+                else:
+                    claimed.append(key)
+
+        print(f"🔒 リースを取得: {len(claimed)}ファイル (ノード {self.leases.owner})")
+        return claimed
+
+    def process_batch(self, limit=None, pipeline=False, workers=None, audio_files=None, final=True,
+                      time_budget=None):
+        """
+        バッチ処理実行
+        audio_files を渡すと一覧取得を省く。final=False（常駐モードの周回）では終了時の集計を出さない。
+        time_budget（秒）を渡すと、カタログの見積もりで予算内に収まるファイルだけを選ぶ
+        """
+        batch_started = time.time()
+        if audio_files is None:
+            audio_files = self.get_audio_files_from_r2()
+            try:
+                pruned = self.file_states.prune(self.r2_objects)
+                if pruned:
+                    print(f"  🧹 元ファイルが消えた・差し替わった進捗を削除: {pruned}件")
+            except Exception as e:
+                print(f"  ⚠️ 進捗の整理エラー: {e}")
+        if self.verify_channel and audio_files:
+            audio_files = self.reconcile_channel(audio_files)
+        count = min(limit, len(audio_files)) if limit else len(audio_files)
+
+        # 今日のクォータで公開まで進められる本数だけに絞る（ダウンロード・変換の前に決める）
+        allowed = self.quota.plan([self._publish_cost(key) for key in audio_files[:count]])
+        print(f"\n📊 APIクォータ: 使用済み {self.quota.used}/{QUOTA_CONFIG['daily_limit']}"
+              f" (1本あたり {self.quota.per_file_cost()}) → 今日あと{allowed}本")
+        if allowed < count:
+            print(f"  ⚠️ クォータ不足のため {count - allowed}ファイルは次回に回します"
+                  f"（{self.quota.reset_time().strftime('%m/%d %H:%M')} に回復）")
+            count = allowed
+
+        if count == 0:
+            # クォータ切れ・対象なし。カタログの調査やダウンロードもしない
+            print(f"\n📊 処理対象: 0ファイル")
+            if final:
+                self.metrics.finish()
+            else:
+                self.metrics.write_prometheus()
+            return
+
+        if time_budget:
+            self.catalog.refresh(audio_files, self.r2_objects, self.extract_title_from_filename, self.probe_remote_duration)
+            stage_workers = dict(PIPELINE_CONFIG['workers'], **(workers or {})) if pipeline else None
+            audio_files = self.catalog.plan(audio_files, time_budget, max_files=count, workers=stage_workers)
+            count = len(audio_files)
+
+        if DEDUP_CONFIG['enabled']:
+            # 今回処理する分だけ指紋を取り、公開済みと同じ録音を外す（一覧取得は読むだけにする）
+            try:
+                with self.metrics.stage('dedup'):
+                    audio_files = self._select_unique(audio_files, count, refill=not time_budget)
+                count = min(count, len(audio_files))
+            except Exception as e:
+                print(f"  ⚠️ 重複チェックをスキップ: {e}")
+
+        if self.leases:
+            audio_files = self._claim_files(audio_files, count)
+        else:
+            audio_files = audio_files[:count]
+
+        total = len(audio_files)
+        print(f"\n📊 処理対象: {total}ファイル")
+        print(f"📊 既に公開済み: {len(self.published_list)}ファイル")
+        print("=" * 60)
+
+        prefetch_dir = None
+        if not self.stream_input and len(audio_files) > 1:
+            # 変換・アップロード中に次のファイルを取っておく
+            prefetch_dir = tempfile.mkdtemp(prefix='yt_prefetch_')
+            sizes = {key: self.r2_objects.get(key, {}).get('size', 0) for key in audio_files}
+            self.prefetcher = Prefetcher(self._prefetch_audio, audio_files, sizes, prefetch_dir, self.metrics).start()
+
+        try:
+            if pipeline:
+                self._process_pipelined(audio_files, workers)
+            else:
+                self._process_sequential(audio_files)
+        finally:
+            if self.prefetcher:
+                self.prefetcher.stop()
+                self.prefetcher = None
+            if prefetch_dir:
+                shutil.rmtree(prefetch_dir, ignore_errors=True)
+            if self.leases:
+                self.leases.stop()
+
         print("\n" + "=" * 60)
         print(f"🎉 バッチ処理完了！")
         print(f"📊 今回処理: {total}ファイル")
         print(f"📊 累計公開: {len(self.published_list)}ファイル")
+        # 実測した時間をカタログに反映（次回の見積もりに使う）
+        self.catalog.observe([e for e in self.metrics.events if e.get('ts', 0) >= batch_started])
+        if self.catalog.files is not None:
+            try:
+                self.catalog.save()
+            except Exception as e:
+                print(f"  ⚠️ カタログの保存エラー: {e}")
+        if self.verify_channel and RECONCILE_CONFIG['poll_timeout'] > 0 and not self.shutdown.is_set():
+            self.check_recent_uploads(since=batch_started)
+        self.transcoder.report()
+        if final:
+            self.metrics.finish()
+        else:
+            self.metrics.write_prometheus()
+
+    def _install_signal_handlers(self):
+        """SIGTERM/SIGINT で停止要求を立てる（2回目は即時終了）"""
+        import signal
+
+        def handle(signum, frame):
+            if self.shutdown.is_set():
+                print("\n🛑 強制終了します")
+                raise KeyboardInterrupt
+            print(f"\n🛑 停止要求を受けました（{signal.Signals(signum).name}）。"
+                  f"処理中のファイルを区切りまで進めて終了します（もう一度で強制終了）")
+            self.shutdown.set()
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, handle)
+
+    def _prepare_cycle(self):
+        """常駐モードの周回前に、認証・履歴・クォータを最新にする（変化が無ければほぼ通信しない）"""
+        self._refresh_credentials_if_needed()
+        if self.history.refresh():
+            print(f"  🔄 履歴を再読込: {len(self.published_list)}件")
+        if self.quota_stop.is_set() and self.quota.available() > 0:
+            print("  ✓ APIクォータが回復しました")
+            self.quota_stop.clear()
+
+    def watch(self, limit=None, pipeline=False, workers=None, poll_seconds=None):
+        """
+        常駐モード: 認証済みクライアントと読み込み済みの履歴を使い回し、
+        poll_seconds 毎にR2の差分を確認して新しい音声を処理する
+        """
+        poll_seconds = poll_seconds or WATCH_CONFIG['poll_seconds']
+        self._install_signal_handlers()
+        print(f"👀 常駐モード開始（{poll_seconds}秒毎に確認、停止は Ctrl+C / SIGTERM）")
+
+        waiting_for_quota = False
+        try:
+            while not self.shutdown.is_set():
+                self._prepare_cycle()
+                # 1000件あたり1リクエスト（R2への書き込みは無い）
+                audio_files = self.get_audio_files_from_r2()
+
+                if audio_files and self.quota.plan([self._publish_cost(audio_files[0])]) == 0:
+                    if not waiting_for_quota:
+                        print(f"  ⏸️ APIクォータ切れ: {self.quota.reset_time().strftime('%m/%d %H:%M')} まで待機します")
+                    waiting_for_quota = True
+                elif audio_files:
+                    waiting_for_quota = False
+                    print(f"\n🆕 未処理 {len(audio_files)}ファイル ({datetime.now().strftime('%H:%M:%S')})")
+                    self.process_batch(
+                        limit=limit, pipeline=pipeline, workers=workers, audio_files=audio_files, final=False
+                    )
+
+                self.shutdown.wait(poll_seconds)
+        finally:
+            self._checkpoint()
+            self.metrics.finish()
+
+    def _checkpoint(self):
+        """終了前に、周回の途中で持っている状態をR2に書き出す"""
+        try:
+            pending = self.upload_sessions.pending()
+            message = f"（再開待ちのアップロード {pending}件）" if pending else ''
+            print(f"💾 状態を保存して終了します{message}")
+        except Exception as e:
+            print(f"  ⚠️ 状態の保存エラー: {e}")
 
 
 def main():
@@ -496,9 +4409,52 @@ def main():
     # コマンドラインパラメータをパース
     parser = argparse.ArgumentParser(description='YouTube自動アップローダー')
     parser.add_argument('--limit', type=int, default=2, 
-                       help='処理する動画数（デフォルト: 2）')
+                       help='処理する動画数（デフォルト: 2、0 で今日のAPIクォータが許す最大数）')
     parser.add_argument('--test', action='store_true',
                        help='テストモード（実際にはアップロードしない）')
+    parser.add_argument('--encode-profile', choices=sorted(ENCODE_PROFILES),
+                       default=ENCODE_CONFIG['profile'],
+                       help='動画変換プロファイル（fast: 静止画向け高速・小容量。音量はどのプロファイルも同じで、'
+                            'ラウドネス測定済みなら目標値に合わせ、未測定なら2倍）')
+    parser.add_argument('--stream-output', action='store_true',
+                       help='動画をディスクに書かず、変換しながらアップロードする（fragmented MP4）')
+    parser.add_argument('--stream-input', action='store_true',
+                       help='音声をダウンロードせずR2から直接 ffmpeg に流して変換する')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='生成物キャッシュを使わない')
+    parser.add_argument('--metrics-file',
+                       help='ステージ毎の計測イベントを JSON Lines で追記するファイル')
+    parser.add_argument('--prom-file',
+                       help='Prometheus textfile collector 形式で計測結果を書き出すファイル')
+    parser.add_argument('--profile', nargs='?', const='profiles', metavar='DIR',
+                       help='ステージ毎の cProfile / tracemalloc を DIR（既定: profiles）に保存')
+    parser.add_argument('--coordinate', action='store_true',
+                       help='R2上のリースで他の実行（別マシン・同時実行）と処理ファイルと公開枠を分け合う')
+    parser.add_argument('--reconcile', action='store_true',
+                       help='チャンネルの動画と履歴を照合してから処理し、アップロード後は処理完了を確認する'
+                            '（youtube.readonly スコープが必要。無ければローカルでは再認証する）')
+    parser.add_argument('--prerender', action='store_true',
+                       help='未公開ファイル全件のサムネイルを並列に事前生成してR2に置く（アップロードしない）')
+    parser.add_argument('--watch', action='store_true',
+                       help='常駐モード: R2を定期的に確認し、新しい音声をすぐに処理する（--limit は1周あたりの本数）')
+    parser.add_argument('--poll-seconds', type=int, default=WATCH_CONFIG['poll_seconds'],
+                       help=f"常駐モードの確認間隔（秒、デフォルト: {WATCH_CONFIG['poll_seconds']}）")
+    parser.add_argument('--time-budget', type=float, metavar='MINUTES',
+                       help='この時間（分）に収まるファイルだけを選んで処理する（--limit は上限、0 で無制限）')
+    parser.add_argument('--no-dedup', action='store_true',
+                       help='音声の指紋による重複チェックをしない')
+    parser.add_argument('--list-quarantine', action='store_true',
+                       help='繰り返し失敗して隔離中のファイルを表示して終了')
+    parser.add_argument('--release', action='append', metavar='KEY', default=[],
+                       help='隔離を解除して次回から再び処理する（複数指定可）')
+    parser.add_argument('--pipeline', action='store_true',
+                       help='ダウンロード・変換・アップロードを並行実行する')
+    parser.add_argument('--download-workers', type=int,
+                       help='パイプラインのダウンロード並列数')
+    parser.add_argument('--encode-workers', type=int,
+                       help='パイプラインの動画変換並列数（ffmpeg の同時実行数）')
+    parser.add_argument('--upload-workers', type=int,
+                       help='パイプラインのアップロード並列数（2以上は --coordinate と一緒に指定）')
     args = parser.parse_args()
     
     print("🎙️ YouTube自動アップローダー起動")
@@ -511,14 +4467,41 @@ def main():
     else:
         print("💻 ローカル環境で実行中")
     
-    print(f"📊 処理数: {args.limit}本")
+    print(f"📊 処理数: {args.limit}本" if args.limit else "📊 処理数: APIクォータの上限まで")
     if args.test:
         print("⚠️ テストモード（アップロードしません）")
     
     print("=" * 60 + "\n")
 
     try:
-        uploader = YouTubeUploader()
+        uploader = YouTubeUploader(
+            metrics=RunMetrics(args.metrics_file, args.prom_file, args.profile)
+        )
+        uploader.encode_profile = args.encode_profile
+        uploader.stream_input = args.stream_input
+        uploader.stream_output = args.stream_output
+        uploader.verify_channel = args.reconcile
+        if args.coordinate:
+            uploader.leases = LeaseManager(uploader.s3_client, R2_CONFIG['bucket_name'])
+        if args.no_cache:
+            CACHE_CONFIG['enabled'] = False
+        if args.no_dedup:
+            DEDUP_CONFIG['enabled'] = False
+        if args.list_quarantine or args.release:
+            uploader.history.load()
+            for key in args.release:
+                uploader.history.release(key)
+                print(f"✓ 隔離を解除しました: {key}")
+            if args.list_quarantine:
+                uploader.print_quarantine()
+            print("\n✅ 処理完了")
+            sys.exit(0)
+
+        if args.prerender:
+            uploader.prerender_thumbnails()
+            print("\n✅ 処理完了")
+            sys.exit(0)
+
         uploader.authenticate_youtube()
         
         if args.test:
@@ -530,11 +4513,41 @@ def main():
                     print(f"  {i}. {f}")
             else:
                 print("\n⚠️ 処理対象のファイルがありません")
+            uploader.metrics.finish()
         else:
-            uploader.process_batch(limit=args.limit)
+            workers = {
+                name: count for name, count in (
+                    ('download', args.download_workers),
+                    ('encode', args.encode_workers),
+                    ('upload', args.upload_workers),
+                ) if count
+            }
+            if workers and not args.pipeline:
+                # 逐次処理は1ファイルずつ全段階を進めるので、段階毎の並列数は使えない
+                print("⚠️ --download-workers / --encode-workers / --upload-workers は --pipeline と一緒に指定してください"
+                      "（今回は1ファイルずつ処理します）")
+                workers = {}
+            if args.watch:
+                uploader.watch(
+                    limit=args.limit,
+                    pipeline=args.pipeline,
+                    workers=workers,
+                    poll_seconds=args.poll_seconds
+                )
+            else:
+                uploader.process_batch(
+                    limit=args.limit,
+                    pipeline=args.pipeline,
+                    workers=workers,
+                    time_budget=args.time_budget * 60 if args.time_budget else None
+                )
         
         print("\n✅ 処理完了")
         sys.exit(0)
+
+    except KeyboardInterrupt:
+        print("\n🛑 中断しました")
+        sys.exit(130)
         
     except Exception as e:
         print(f"\n❌ 致命的エラー: {e}")